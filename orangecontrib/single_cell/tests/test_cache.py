@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import scipy.sparse as sp
+
+from Orange.data import Table, Domain
+
+from orangecontrib.single_cell.widgets.cache import DiskCache, cache_key, \
+    fingerprint, same_content
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.matrix = sp.random(100, 100, density=0.1, format='csr',
+                                random_state=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache_key(self):
+        x = np.arange(12, dtype=float).reshape(3, 4)
+        self.assertEqual(cache_key(x, 10, 'l2'), cache_key(x.copy(), 10, 'l2'))
+        self.assertNotEqual(cache_key(x, 10, 'l2'), cache_key(x, 11, 'l2'))
+        self.assertNotEqual(cache_key(x, 10), cache_key(x.reshape(4, 3), 10))
+        self.assertNotEqual(cache_key(x), cache_key(x.astype(np.float32)))
+        self.assertEqual(cache_key(self.matrix), cache_key(self.matrix.tocoo()))
+
+    def test_fingerprint(self):
+        x = np.random.RandomState(0).rand(100, 10)
+        table = Table.from_numpy(Domain.from_numpy(x), x)
+        self.assertEqual(fingerprint(table), fingerprint(x))
+        self.assertEqual(fingerprint(x), fingerprint(x.copy()))
+        self.assertEqual(fingerprint(x[:, ::2]), fingerprint(x[:, ::2].copy()))
+        self.assertNotEqual(fingerprint(x), fingerprint(x[:, ::2]))
+        self.assertNotEqual(fingerprint(x), fingerprint(x.T))
+        self.assertEqual(fingerprint(self.matrix),
+                         fingerprint(self.matrix.tocsc()))
+        self.assertNotEqual(fingerprint(self.matrix),
+                            fingerprint(self.matrix.toarray()))
+
+        # The digest is stored on the table until X is replaced
+        digest = fingerprint(table)
+        with patch('orangecontrib.single_cell.widgets.cache.fingerprint',
+                   side_effect=AssertionError):
+            self.assertEqual(fingerprint(table), digest)
+        table.X = x[::-1].copy()
+        self.assertNotEqual(fingerprint(table), digest)
+
+    def test_fingerprint_hashes_all_rows(self):
+        x = np.random.RandomState(0).rand(5000, 3)
+        changed = x.copy()
+        changed[1, 0] = np.nan
+        self.assertNotEqual(fingerprint(x), fingerprint(changed))
+        self.assertNotEqual(cache_key(x), cache_key(changed))
+        tables = [Table.from_numpy(Domain.from_numpy(x), data)
+                  for data in (x, changed)]
+        self.assertNotEqual(cache_key(tables[0]), cache_key(tables[1]))
+
+    def test_same_content(self):
+        x = np.random.RandomState(0).rand(5000, 3)
+        table = Table.from_numpy(Domain.from_numpy(x), x)
+        self.assertTrue(same_content(table, Table.from_numpy(
+            table.domain, x.copy())))
+        self.assertTrue(same_content(self.matrix, self.matrix.tocsc()))
+
+        # Rows outside the sample are compared too
+        changed = x.copy()
+        changed[1, 0] = np.nan
+        self.assertFalse(same_content(x, changed))
+        self.assertFalse(same_content(
+            table, Table.from_numpy(table.domain, changed)))
+
+        # In-place changes of the sampled rows and of the sparsity pattern
+        # are detected, even after the digest was stored on the table
+        fingerprint(table)
+        copy = Table.from_numpy(table.domain, x.copy())
+        table.X[0, 0] += 1
+        self.assertFalse(same_content(table, copy))
+        matrix = self.matrix.copy()
+        matrix[50, matrix[50].indices[0]] = 0
+        matrix.eliminate_zeros()
+        self.assertFalse(same_content(self.matrix, matrix))
+
+    def test_sparse_roundtrip(self):
+        cache = DiskCache(os.path.join(self.directory, 'cache'), 1e8)
+        self.assertIsNone(cache.load_sparse('a'))
+        cache.save_sparse('a', self.matrix)
+        loaded = cache.load_sparse('a')
+        self.assertIsInstance(loaded, sp.csr_matrix)
+        np.testing.assert_equal(loaded.toarray(), self.matrix.toarray())
+
+    def test_array_roundtrip(self):
+        cache = DiskCache(self.directory, 1e8)
+        array = np.random.RandomState(0).rand(50, 2).astype(np.float32)
+        self.assertIsNone(cache.load_array('a'))
+        cache.save_array('a', array)
+        loaded = cache.load_array('a')
+        self.assertIsInstance(loaded, np.memmap)
+        self.assertFalse(loaded.flags.writeable)
+        np.testing.assert_equal(loaded, array)
+        self.assertEqual(loaded.dtype, np.float32)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_broken_entry(self):
+        cache = DiskCache(self.directory, 1e8)
+        with open(os.path.join(self.directory, 'a.npz'), 'wb') as f:
+            f.write(b'not a matrix')
+        self.assertIsNone(cache.load_sparse('a'))
+        self.assertFalse(os.listdir(self.directory))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_least_recently_used_are_evicted(self):
+        cache = DiskCache(self.directory, 1e8)
+        for key in 'abc':
+            cache.save_sparse(key, self.matrix)
+            time.sleep(0.01)
+        entry_size = os.path.getsize(os.path.join(self.directory, 'a.npz'))
+        cache.size_limit = 3.5 * entry_size
+
+        self.assertIsNotNone(cache.load_sparse('a'))
+        cache.save_sparse('d', self.matrix)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['a.npz', 'c.npz', 'd.npz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
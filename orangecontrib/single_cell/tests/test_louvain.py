@@ -0,0 +1,321 @@
+import os
+import threading
+import time
+import unittest
+from concurrent.futures import CancelledError
+from unittest.mock import patch
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from orangecontrib.single_cell.widgets import louvain, louvain_csr
+
+
+def knn_graph(n_clusters=4, n_points=50, k=10, seed=0):
+    """Build a Jaccard weighted kNN graph the same way the widget does."""
+    rs = np.random.RandomState(seed)
+    x = np.vstack([rs.randn(n_points, 5) + 5 * rs.randn(5)
+                   for _ in range(n_clusters)])
+    dist = ((x[:, None] - x[None, :]) ** 2).sum(axis=2)
+    neighbours = list(map(set, np.argsort(dist, axis=1)[:, :k]))
+
+    graph = nx.Graph()
+    graph.add_nodes_from(range(len(x)))
+    for node, node_neighbours in enumerate(neighbours):
+        for neighbour in node_neighbours:
+            shared = node_neighbours & neighbours[neighbour]
+            union = node_neighbours | neighbours[neighbour]
+            graph.add_edge(node, neighbour, weight=len(shared) / len(union))
+    return graph
+
+
+def sorted_graph(graph):
+    """Rebuild the graph with sorted nodes and neighbourhoods, the order in
+    which they appear in a CSR matrix. Reference results depend on it."""
+    result = nx.Graph()
+    result.add_nodes_from(sorted(graph.nodes()))
+    result.add_edges_from(sorted(graph.edges(data=True)))
+    return result
+
+
+class TestLouvainCSR(unittest.TestCase):
+    def setUp(self):
+        self.graphs = [
+            sorted_graph(nx.karate_club_graph()),
+            sorted_graph(knn_graph(seed=0)),
+            sorted_graph(knn_graph(seed=1)),
+        ]
+
+    @staticmethod
+    def as_array(partition, graph):
+        return np.array([partition[node] for node in graph.nodes()])
+
+    def test_best_partition_matches_reference(self):
+        for graph in self.graphs:
+            expected = self.as_array(louvain.best_partition(graph), graph)
+            adjacency = louvain_csr.graph_to_adjacency(graph)
+            np.testing.assert_equal(
+                louvain_csr.best_partition(adjacency), expected)
+
+    def test_dendrogram_matches_reference(self):
+        graph = self.graphs[1]
+        expected = louvain.generate_dendrogram(graph)
+        dendrogram = louvain_csr.generate_dendrogram(graph)
+        self.assertEqual(len(dendrogram), len(expected))
+        for level in range(len(expected)):
+            np.testing.assert_equal(
+                louvain_csr.partition_at_level(dendrogram, level),
+                self.as_array(louvain.partition_at_level(expected, level),
+                              graph))
+
+    def test_modularity_matches_reference(self):
+        graph = self.graphs[1]
+        partition = louvain.best_partition(graph)
+        self.assertAlmostEqual(
+            louvain_csr.modularity(self.as_array(partition, graph), graph),
+            louvain.modularity(partition, graph))
+
+    def test_dendrogram_modularity(self):
+        graph = self.graphs[2]
+        dendrogram, modularities = louvain_csr.generate_dendrogram(
+            graph, return_modularity=True)
+        self.assertEqual(len(dendrogram), len(modularities))
+        for level, expected in enumerate(modularities):
+            partition = louvain_csr.partition_at_level(dendrogram, level)
+            self.assertAlmostEqual(
+                louvain_csr.modularity(partition, graph), expected)
+
+    def test_modularity_scores(self):
+        adjacency = louvain_csr.graph_to_adjacency(self.graphs[1])
+        partitions = np.vstack([
+            louvain_csr.best_partition(adjacency, resolution=resolution)
+            for resolution in (0.5, 1., 2.)])
+        scores, contributions = louvain_csr.modularity_scores(
+            partitions, adjacency, return_contributions=True)
+        self.assertEqual(scores.shape, (3,))
+        self.assertEqual(contributions.shape,
+                         (3, partitions.max() + 1))
+        for labels, score, contribution in zip(partitions, scores,
+                                               contributions):
+            self.assertAlmostEqual(
+                score, louvain_csr.modularity(labels, adjacency))
+            self.assertAlmostEqual(contribution.sum(), score)
+            self.assertTrue(np.all(contribution[labels.max() + 1:] == 0))
+
+        score = louvain_csr.modularity_scores(partitions[0], self.graphs[1])
+        self.assertAlmostEqual(score, scores[0])
+        # Labels of communities of a single node
+        self.assertAlmostEqual(
+            louvain_csr.modularity_scores(
+                np.arange(adjacency.shape[0]), adjacency),
+            louvain.modularity(dict(enumerate(range(adjacency.shape[0]))),
+                               self.graphs[1]))
+        with self.assertRaises(ValueError):
+            louvain_csr.modularity_scores(-partitions, adjacency)
+
+    def test_initial_partition(self):
+        adjacency = louvain_csr.graph_to_adjacency(self.graphs[1])
+        partition = louvain_csr.best_partition(adjacency)
+        warm = louvain_csr.best_partition(adjacency, partition=partition)
+        self.assertGreaterEqual(
+            louvain_csr.modularity(warm, adjacency) + 1e-9,
+            louvain_csr.modularity(partition, adjacency))
+
+    def test_randomize(self):
+        adjacency = louvain_csr.graph_to_adjacency(self.graphs[2])
+        partition1 = louvain_csr.best_partition(
+            adjacency, randomize=True, random_state=0)
+        partition2 = louvain_csr.best_partition(
+            adjacency, randomize=True, random_state=0)
+        np.testing.assert_equal(partition1, partition2)
+
+    def test_induced_graph(self):
+        n = 5
+        graph = nx.complete_graph(2 * n)
+        partition = np.arange(2 * n) % 2
+
+        induced = louvain_csr.induced_graph(partition, graph)
+        np.testing.assert_equal(
+            induced.toarray(),
+            [[n * (n - 1) / 2, n * n], [n * n, n * (n - 1) / 2]])
+
+        expected = nx.Graph()
+        expected.add_weighted_edges_from(
+            [(0, 1, n * n), (0, 0, n * (n - 1) / 2), (1, 1, n * (n - 1) / 2)])
+        induced = louvain.induced_graph(dict(enumerate(partition)), graph)
+        self.assertEqual(sorted(induced.edges(data=True)),
+                         sorted(expected.edges(data=True)))
+
+    def test_leiden(self):
+        for graph in self.graphs:
+            adjacency = louvain_csr.graph_to_adjacency(graph)
+            partition = louvain_csr.best_partition(
+                adjacency, method='leiden', random_state=0)
+            self.assertGreater(
+                louvain_csr.modularity(partition, adjacency),
+                louvain_csr.modularity(
+                    louvain_csr.best_partition(adjacency), adjacency) - 0.01)
+            # Leiden communities are always connected
+            for community in np.unique(partition):
+                nodes = np.flatnonzero(partition == community)
+                n_components, _ = connected_components(
+                    adjacency[nodes][:, nodes])
+                self.assertEqual(n_components, 1)
+
+    def test_leiden_is_deterministic(self):
+        adjacency = louvain_csr.graph_to_adjacency(self.graphs[1])
+        partition = louvain_csr.best_partition(adjacency, method='leiden')
+        for _ in range(3):
+            np.testing.assert_equal(
+                louvain_csr.best_partition(adjacency, method='leiden'),
+                partition)
+
+    def test_partition_sweep(self):
+        adjacency = louvain_csr.graph_to_adjacency(self.graphs[1])
+        resolutions = [0.5, 1., 2.]
+        for n_jobs in (1, 2):
+            results = louvain_csr.partition_sweep(
+                adjacency, resolutions, n_jobs=n_jobs)
+            self.assertEqual([r.resolution for r in results], resolutions)
+            for result in results:
+                partition = louvain_csr.best_partition(
+                    adjacency, resolution=result.resolution)
+                np.testing.assert_equal(result.partition, partition)
+                self.assertEqual(result.n_clusters, len(np.unique(partition)))
+                self.assertAlmostEqual(
+                    result.modularity,
+                    louvain_csr.modularity(partition, adjacency))
+
+    def test_ensemble_partition(self):
+        adjacency = louvain_csr.graph_to_adjacency(self.graphs[1])
+        partition, stability = louvain_csr.ensemble_partition(
+            adjacency, n_runs=4, n_jobs=2, random_state=0)
+        self.assertEqual(partition.shape, (adjacency.shape[0],))
+        self.assertTrue(np.all((stability >= 0) & (stability <= 1)))
+        self.assertGreater(
+            louvain_csr.modularity(partition, adjacency),
+            louvain_csr.modularity(
+                louvain_csr.best_partition(adjacency), adjacency) - 0.05)
+
+        # Worker processes do not change the result
+        serial = louvain_csr.ensemble_partition(
+            adjacency, n_runs=4, n_jobs=1, random_state=0)
+        np.testing.assert_equal(serial[0], partition)
+        np.testing.assert_equal(serial[1], stability)
+
+    def test_progress_callback(self):
+        for method in ('louvain', 'leiden'):
+            progress = []
+            louvain_csr.best_partition(self.graphs[1], method=method,
+                                       progress_callback=progress.append)
+            self.assertTrue(progress)
+            self.assertEqual(progress, sorted(progress))
+            self.assertTrue(all(0 <= p < 1 for p in progress))
+
+    def test_cancel(self):
+        cancel_token = threading.Event()
+        cancel_token.set()
+        for method in ('louvain', 'leiden'):
+            with self.assertRaises(CancelledError):
+                louvain_csr.best_partition(self.graphs[1], method=method,
+                                           cancel_token=cancel_token)
+
+    def test_run_in_process(self):
+        adjacency = louvain_csr.graph_to_adjacency(self.graphs[1])
+        progress = []
+        dendrogram = louvain_csr.run_in_process(
+            louvain_csr.generate_dendrogram, adjacency, resolution=0.5,
+            progress_callback=progress.append)
+        expected = louvain_csr.generate_dendrogram(adjacency, resolution=0.5)
+        self.assertEqual(len(dendrogram), len(expected))
+        for level, labels in zip(expected, dendrogram):
+            np.testing.assert_equal(level, labels)
+        self.assertTrue(progress)
+
+        partition, stability = louvain_csr.run_in_process(
+            louvain_csr.ensemble_partition, adjacency, n_runs=2, n_jobs=1,
+            random_state=0)
+        expected = louvain_csr.ensemble_partition(
+            adjacency, n_runs=2, n_jobs=1, random_state=0)
+        np.testing.assert_equal(partition, expected[0])
+        np.testing.assert_equal(stability, expected[1])
+
+        with self.assertRaises(ValueError):
+            louvain_csr.run_in_process(louvain_csr.best_partition, adjacency,
+                                       method='unknown')
+
+    def test_without_shared_memory(self):
+        adjacency = louvain_csr.graph_to_adjacency(self.graphs[1])
+        expected = louvain_csr.generate_dendrogram(adjacency, resolution=0.5)
+        with patch.object(louvain_csr, 'SharedMemory', None):
+            dendrogram = louvain_csr.run_in_process(
+                louvain_csr.generate_dendrogram, adjacency, resolution=0.5)
+            results = louvain_csr.partition_sweep(
+                adjacency, [0.5, 1.], n_jobs=2)
+        for level, labels in zip(expected, dendrogram):
+            np.testing.assert_equal(level, labels)
+        np.testing.assert_equal(
+            results[1].partition, louvain_csr.best_partition(adjacency))
+
+    def test_cancel_process(self):
+        cancel_token = threading.Event()
+        cancel_token.set()
+        with self.assertRaises(CancelledError):
+            louvain_csr.run_in_process(louvain_csr.best_partition,
+                                       self.graphs[1], cancel_token=cancel_token)
+
+    @unittest.skipUnless(os.path.isdir('/dev/shm'),
+                         "Shared memory blocks are not listed in /dev/shm")
+    def test_cancel_process_pool(self):
+        self._cancel_process_pool()
+
+    @unittest.skipUnless(os.path.isdir('/dev/shm'),
+                         "Shared memory blocks are not listed in /dev/shm")
+    def test_cancel_process_pool_without_signals(self):
+        # Windows terminates processes without running their clean-up, so
+        # a cancelled task must stop by itself
+        with patch('multiprocessing.process.BaseProcess.terminate'):
+            self._cancel_process_pool()
+
+    def _cancel_process_pool(self):
+        def shared_blocks():
+            return set(os.listdir('/dev/shm'))
+
+        before = shared_blocks()
+        cancel_token = threading.Event()
+
+        def cancel():
+            # Wait until the worker has shared the adjacency with its pool
+            # of processes, in addition to the blocks shared by the caller
+            for _ in range(300):
+                if len(shared_blocks() - before) >= 6:
+                    break
+                time.sleep(0.01)
+            cancel_token.set()
+
+        adjacency = louvain_csr.graph_to_adjacency(knn_graph(n_points=100))
+        thread = threading.Thread(target=cancel)
+        thread.start()
+        with self.assertRaises(CancelledError):
+            louvain_csr.run_in_process(
+                louvain_csr.ensemble_partition, adjacency,
+                cancel_token=cancel_token, n_runs=500, n_jobs=2)
+        thread.join()
+        self.assertEqual(shared_blocks() - before, set())
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            louvain_csr.best_partition(self.graphs[0], method='unknown')
+
+    def test_graph_without_links(self):
+        adjacency = sp.csr_matrix((5, 5))
+        np.testing.assert_equal(
+            louvain_csr.best_partition(adjacency), np.arange(5))
+        with self.assertRaises(ValueError):
+            louvain_csr.modularity(np.zeros(5, dtype=int), adjacency)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import time
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.neighbors import NearestNeighbors
+
+from orangecontrib.single_cell.widgets import nearest_neighbors as nn
+
+
+class TestNearestNeighbors(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        # Points on a low dimensional manifold in clusters, like PCA
+        # projections of cells
+        centers = 5 * random_state.randn(10, 10)
+        self.x = (random_state.randn(6000, 3).dot(random_state.randn(3, 10))
+                  + centers[random_state.randint(10, size=6000)]
+                  + 0.1 * random_state.randn(6000, 10))
+
+    def test_exact(self):
+        distances, indices = nn.nearest_neighbors(self.x[:500], 10)
+        expected = NearestNeighbors(n_neighbors=10).fit(self.x[:500]) \
+            .kneighbors(self.x[:500])
+        np.testing.assert_almost_equal(distances, expected[0])
+        np.testing.assert_equal(indices, expected[1])
+        self.assertEqual(nn.estimate_recall(self.x[:500], indices), 1)
+
+    def test_exact_blocks(self):
+        x = self.x[:1000]
+        for metric in ('l2', 'l1'):
+            expected = NearestNeighbors(n_neighbors=10, metric=metric) \
+                .fit(x).kneighbors(x)
+            progress = []
+            # Blocks of 10 rows
+            distances, indices = nn.nearest_neighbors(
+                x, 10, metric=metric, n_jobs=3, memory_budget=8 * 1000 * 30,
+                progress_callback=progress.append)
+            np.testing.assert_equal(distances, expected[0])
+            np.testing.assert_equal(indices, expected[1])
+            self.assertEqual(len(progress), 100)
+            self.assertEqual(progress, sorted(progress))
+
+    def test_small_data_is_searched_exactly(self):
+        x = self.x[:500]
+        exact = nn.nearest_neighbors(x, 10)
+        approximate = nn.nearest_neighbors(x, 10, backend='rp_forest')
+        np.testing.assert_equal(approximate[1], exact[1])
+
+    def test_rp_forest(self):
+        for metric in ('l2', 'l1'):
+            distances, indices = nn.nearest_neighbors(
+                self.x, 15, metric=metric, backend='rp_forest', n_trees=5,
+                random_state=0)
+            self.assertEqual(indices.shape, (len(self.x), 15))
+            # Points are their own nearest neighbours
+            np.testing.assert_equal(indices[:, 0], np.arange(len(self.x)))
+            self.assertTrue(np.all(np.diff(distances, axis=1) >= 0))
+            for row in indices[:100]:
+                self.assertEqual(len(np.unique(row)), 15)
+            self.assertGreater(
+                nn.estimate_recall(self.x, indices, metric, random_state=0),
+                0.9)
+
+    def test_more_trees_increase_recall(self):
+        recalls = [
+            nn.estimate_recall(self.x, nn.nearest_neighbors(
+                self.x, 15, backend='rp_forest', n_trees=n_trees,
+                random_state=0)[1], random_state=0)
+            for n_trees in (1, 8)]
+        self.assertGreater(recalls[1], recalls[0])
+
+    def test_recall_and_time(self):
+        """More trees take longer and find more of the true neighbours."""
+        random_state = np.random.RandomState(0)
+        centers = 5 * random_state.randn(10, 50)
+        x = (random_state.randn(10000, 5).dot(random_state.randn(5, 50))
+             + centers[random_state.randint(10, size=10000)]
+             + 0.1 * random_state.randn(10000, 50))
+        times, recalls = [], []
+        for n_trees in (1, 3, 10):
+            start = time.perf_counter()
+            _, indices = nn.nearest_neighbors(
+                x, 15, backend='rp_forest', n_trees=n_trees, random_state=0)
+            times.append(time.perf_counter() - start)
+            recalls.append(nn.estimate_recall(x, indices, random_state=0))
+        self.assertEqual(recalls, sorted(recalls))
+        self.assertLess(times[0], times[-1])
+        self.assertGreater(recalls[-1], 0.95)
+
+    def test_cosine_and_correlation(self):
+        x = self.x[:500]
+        for metric in ('cosine', 'correlation'):
+            expected = NearestNeighbors(n_neighbors=10, metric=metric,
+                                        algorithm='brute').fit(x).kneighbors(x)
+            distances, indices = nn.nearest_neighbors(x, 10, metric=metric)
+            np.testing.assert_almost_equal(distances, expected[0])
+            np.testing.assert_equal(indices, expected[1])
+            np.testing.assert_almost_equal(
+                nn.pair_distances(x, np.arange(500), indices[:, 3], metric),
+                expected[0][:, 3])
+        np.testing.assert_almost_equal(
+            nn.pair_distances(x, [0, 1], [2, 3], 'l1'),
+            np.abs(x[[0, 1]] - x[[2, 3]]).sum(axis=1))
+
+    def test_sparse_pair_distances(self):
+        x = self.x[:100].copy()
+        x[x < 0.5] = 0
+        rows, columns = np.arange(100), np.arange(100)[::-1]
+        for metric in ('l2', 'l1', 'cosine', 'correlation'):
+            np.testing.assert_almost_equal(
+                nn.pair_distances(sp.csr_matrix(x), rows, columns, metric),
+                nn.pair_distances(x, rows, columns, metric))
+
+    def test_invalid_parameters(self):
+        with self.assertRaises(ValueError):
+            nn.nearest_neighbors(self.x, 10, backend='unknown')
+        with self.assertRaises(ValueError):
+            nn.nearest_neighbors(self.x, 10, metric='chebyshev',
+                                 backend='rp_forest')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,16 @@
+import shutil
+import tempfile
+import unittest
 from unittest.mock import patch
 
 import numpy as np
 
 from Orange.data import Table, Domain, ContinuousVariable
 from Orange.widgets.tests.base import WidgetTest
+from orangecontrib.single_cell.widgets import owlouvainclustering
+from orangecontrib.single_cell.widgets.cache import DiskCache
 from orangecontrib.single_cell.widgets.owlouvainclustering import \
-    OWLouvainClustering
+    OWLouvainClustering, prune_links, table_to_graph
 
 # Deterministic tests
 np.random.seed(42)
@@ -13,6 +18,14 @@ np.random.seed(42)
 
 class TestOWLouvain(WidgetTest):
     def setUp(self):
+        # Keep the graphs of the tests out of the user's cache
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = patch.object(owlouvainclustering, 'graph_cache',
+                               DiskCache(directory, size_limit=1e8))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         self.widget = self.create_widget(
             OWLouvainClustering, stored_settings={'auto_commit': False}
         )
@@ -36,7 +49,7 @@ class TestOWLouvain(WidgetTest):
         self.send_signal(self.widget.Inputs.data, table)
         self.widget.k_neighbours = 4
         self.widget.unconditional_commit()
-        output = self.get_output(self.widget.Outputs.annotated_data, wait=1000)
+        output = self.get_output(self.widget.Outputs.annotated_data, wait=5000)
 
         clustering = output.get_column_view('Cluster')[0].astype(int)
         counts = np.bincount(clustering)
@@ -54,6 +67,39 @@ class TestOWLouvain(WidgetTest):
 
         self.assertTrue(self.widget.Error.data_has_nans.is_shown())
 
+    def test_cancel_unblocks_widget(self):
+        """Cancelled runs should not leave the widget blocked."""
+        data = np.random.rand(100, 5)
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+        self.send_signal(self.widget.Inputs.data, table)
+        self.widget.unconditional_commit()
+        self.assertTrue(self.widget.isBlocking())
+
+        data = data.copy()
+        data[0, 0] = np.nan
+        self.widget.apply_pca = False
+        # Blocked widgets do not accept signals
+        self.widget.set_data(Table.from_numpy(
+            domain=Domain.from_numpy(X=data), X=data))
+        self.widget.unconditional_commit()
+        self.assertTrue(self.widget.Error.data_has_nans.is_shown())
+        self.assertFalse(self.widget.isBlocking())
+
+    def test_resend_data_with_missing_values(self):
+        """Data that could not be clustered is checked again when resent."""
+        data = np.random.rand(20, 5)
+        data[0, 0] = np.nan
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+        self.widget.apply_pca = False
+        self.send_signal(self.widget.Inputs.data, table)
+        self.widget.unconditional_commit()
+        self.assertTrue(self.widget.Error.data_has_nans.is_shown())
+
+        self.send_signal(self.widget.Inputs.data, table.copy())
+        self.widget.unconditional_commit()
+        self.assertTrue(self.widget.Error.data_has_nans.is_shown())
+        self.assertIsNone(self.get_output(self.widget.Outputs.annotated_data))
+
     def test_empty_dataset(self):
         # Prepare a table with 5 rows with only meta attributes
         meta = np.array([0] * 5)
@@ -100,3 +146,221 @@ class TestOWLouvain(WidgetTest):
             self.send_signal(self.widget.Inputs.data, table3)
             self.commit_and_wait()
             self.assertEqual(call_count + 1, commit.call_count)
+
+    def test_reuse_partition_on_previous_resolution(self):
+        """Going back to an already computed resolution should be instant."""
+        data = np.random.rand(30, 3)
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+
+        self.send_signal(self.widget.Inputs.data, table)
+        self.widget.unconditional_commit()
+        self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+        partition = self.widget.partition
+
+        self.widget.resolution = 2
+        self.widget._update_resolution()
+        self.widget.unconditional_commit()
+        self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+
+        with patch('orangecontrib.single_cell.widgets.owlouvainclustering.'
+                   'generate_dendrogram') as generate_dendrogram:
+            self.widget.resolution = 1
+            self.widget._update_resolution()
+            self.widget.unconditional_commit()
+            generate_dendrogram.assert_not_called()
+        np.testing.assert_equal(self.widget.partition, partition)
+
+    def test_consensus_outputs_stability(self):
+        data = np.random.rand(30, 3)
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+
+        self.widget.use_ensemble = True
+        self.widget.ensemble_runs = 3
+        self.send_signal(self.widget.Inputs.data, table)
+        self.widget.unconditional_commit()
+        output = self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+
+        stability = output.get_column_view('Stability')[0]
+        self.assertTrue(np.all((stability >= 0) & (stability <= 1)))
+
+    def test_warm_start_from_previous_partition(self):
+        """Rows that were clustered before seed the next clustering."""
+        data = np.random.rand(30, 3)
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+
+        self.send_signal(self.widget.Inputs.data, table)
+        self.widget.unconditional_commit()
+        self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+        partition = self.widget.partition
+
+        # Send the same rows with five new ones appended
+        new_data = np.vstack((data, np.random.rand(5, 3)))
+        new_table = Table.from_numpy(
+            domain=Domain.from_numpy(X=new_data), X=new_data)
+        new_table.ids[:len(table)] = table.ids
+        self.send_signal(self.widget.Inputs.data, new_table)
+        initial = self.widget._initial_partition()
+        np.testing.assert_equal(initial[:len(table)], partition)
+        self.assertEqual(len(np.unique(initial[len(table):])), 5)
+
+        self.widget.warm_start = False
+        self.assertIsNone(self.widget._initial_partition())
+
+    def test_warm_start_keeps_dendrogram(self):
+        """Only a Leiden run starts from the previous partition."""
+        self.assertFalse(self.widget.warm_start_cbx.isEnabled())
+        data = np.random.rand(30, 3)
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+        self.send_signal(self.widget.Inputs.data, table)
+        self.widget.unconditional_commit()
+        self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+
+        with patch.object(owlouvainclustering, 'run_in_process',
+                          wraps=owlouvainclustering.run_in_process) as run:
+            self.widget.resolution = 0.5
+            self.widget._update_resolution()
+            self.widget.unconditional_commit()
+            self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+            self.assertNotIn('part_init', run.call_args[1])
+
+            self.widget.method_idx = 1
+            self.widget._update_method()
+            self.assertTrue(self.widget.warm_start_cbx.isEnabled())
+            self.widget.unconditional_commit()
+            self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+            self.assertIsNotNone(run.call_args[1]['partition'])
+
+    def test_select_dendrogram_level(self):
+        """Switching levels should not recompute the clustering."""
+        data = np.vstack([np.random.rand(20, 2) + 3 * i for i in range(6)])
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+
+        self.send_signal(self.widget.Inputs.data, table)
+        self.widget.k_neighbours = 4
+        self.widget.output_levels = True
+        self.widget.unconditional_commit()
+        output = self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+
+        dendrogram = self.widget.dendrogram
+        n_levels = len(dendrogram)
+        self.assertEqual(self.widget.level_combo.count(), n_levels)
+        self.assertEqual(self.widget.level, n_levels - 1)
+        if n_levels > 1:
+            self.assertIn('Cluster (level 1)', output.domain)
+
+        with patch('orangecontrib.single_cell.widgets.owlouvainclustering.'
+                   'generate_dendrogram') as generate_dendrogram, \
+                patch('orangecontrib.single_cell.widgets.owlouvainclustering.'
+                      'pair_distances') as pair_distances:
+            self.widget.dendrogram_level = 0
+            self.widget._update_level()
+            self.widget.unconditional_commit()
+            generate_dendrogram.assert_not_called()
+            pair_distances.assert_not_called()
+        self.assertIs(self.widget.dendrogram, dendrogram)
+        np.testing.assert_equal(self.widget.partition, dendrogram[0])
+
+    def test_smaller_k_reuses_neighbours(self):
+        """Decreasing k should not search the neighbours again."""
+        data = np.random.rand(100, 5)
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+
+        self.widget.apply_pca = False
+        self.widget.max_k_neighbours = 20
+        self.send_signal(self.widget.Inputs.data, table)
+        self.widget.k_neighbours = 10
+        self.widget._update_k_neighbors()
+        self.widget.unconditional_commit()
+        self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+        neighbours = self.widget.neighbours
+        self.assertEqual(neighbours[1].shape, (len(data), 20))
+
+        with patch('orangecontrib.single_cell.widgets.owlouvainclustering.'
+                   'nearest_neighbors') as nearest_neighbors, \
+                patch('orangecontrib.single_cell.widgets.owlouvainclustering.'
+                      'graph_cache.load_sparse', return_value=None):
+            self.widget.k_neighbours = 5
+            self.widget._update_k_neighbors()
+            self.widget.unconditional_commit()
+            self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+            nearest_neighbors.assert_not_called()
+        self.assertIs(self.widget.neighbours, neighbours)
+        np.testing.assert_equal(
+            self.widget.graph.toarray(),
+            table_to_graph(table, 5, 'l2').toarray())
+
+        self.widget.k_neighbours = 30
+        self.widget._update_k_neighbors()
+        self.assertIsNone(self.widget.neighbours)
+
+    def test_smaller_k_reuses_cached_neighbours(self):
+        """Neighbours are restored with a cached graph and reused."""
+        data = np.random.rand(100, 5)
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+
+        self.widget.apply_pca = False
+        self.widget.max_k_neighbours = 20
+        self.send_signal(self.widget.Inputs.data, table)
+        self.widget.k_neighbours = 10
+        self.widget._update_k_neighbors()
+        self.widget.unconditional_commit()
+        self.get_output(self.widget.Outputs.annotated_data, wait=5000)
+        neighbours = self.widget.neighbours
+
+        widget = self.create_widget(
+            OWLouvainClustering, stored_settings={'auto_commit': False})
+        self.addCleanup(widget.onDeleteWidget)
+        widget.apply_pca = False
+        self.send_signal(widget.Inputs.data, table, widget=widget)
+        widget.k_neighbours = 10
+        widget._update_k_neighbors()
+        with patch.object(owlouvainclustering, 'nearest_neighbors') \
+                as nearest_neighbors:
+            widget.unconditional_commit()
+            self.get_output(widget.Outputs.annotated_data, widget=widget,
+                            wait=5000)
+            np.testing.assert_equal(widget.neighbours[1], neighbours[1])
+
+            widget.k_neighbours = 5
+            widget._update_k_neighbors()
+            widget.unconditional_commit()
+            self.get_output(widget.Outputs.annotated_data, widget=widget,
+                            wait=5000)
+            nearest_neighbors.assert_not_called()
+
+
+class TestTableToGraph(unittest.TestCase):
+    def test_jaccard_weights(self):
+        """Links are weighted by the Jaccard similarity of neighbourhoods."""
+        data = np.random.rand(100, 3)
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+        k = 5
+
+        adjacency = table_to_graph(table, k_neighbours=k, metric='l2')
+        self.assertEqual(adjacency.shape, (len(data), len(data)))
+        self.assertEqual((adjacency != adjacency.T).nnz, 0)
+
+        distances = ((data[:, None] - data[None, :]) ** 2).sum(axis=2)
+        neighbours = [set(np.argsort(row)[:k])
+                      for row in distances]
+        expected = np.zeros_like(distances)
+        for node, node_neighbours in enumerate(neighbours):
+            for neighbour in node_neighbours:
+                expected[node, neighbour] = expected[neighbour, node] = len(
+                    node_neighbours & neighbours[neighbour]
+                ) / len(node_neighbours | neighbours[neighbour])
+        np.testing.assert_almost_equal(adjacency.toarray(), expected)
+
+    def test_prune_links(self):
+        data = np.random.rand(100, 3)
+        table = Table.from_numpy(domain=Domain.from_numpy(X=data), X=data)
+        adjacency = table_to_graph(table, k_neighbours=10, metric='l2')
+
+        pruned = prune_links(adjacency, 0.2)
+        self.assertIs(prune_links(adjacency, 0), adjacency)
+        self.assertEqual((pruned != pruned.T).nnz, 0)
+        self.assertTrue(np.all(pruned.data >= 0.2))
+        self.assertEqual(pruned.nnz, np.sum(adjacency.data >= 0.2))
+        np.testing.assert_equal(
+            table_to_graph(table, 10, 'l2', prune=0.2).toarray(),
+            pruned.toarray())
@@ -1,5 +1,12 @@
+import shutil
+import tempfile
 import unittest
+from unittest.mock import patch
 
+import numpy as np
+
+from orangecontrib.single_cell.widgets import owtsne
+from orangecontrib.single_cell.widgets.cache import DiskCache
 from orangecontrib.single_cell.widgets.owtsne import OWtSNE
 from Orange.widgets.tests.base import WidgetTest
 from Orange.data import DiscreteVariable, ContinuousVariable, Domain, Table
@@ -58,6 +65,24 @@ class TestOWtSNE(WidgetTest):
 
         self.send_signal(self.widget.Inputs.data, self.data)
 
+    def test_cached_affinities(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        data = Table(self.domain, np.random.RandomState(0).rand(20, 5),
+                     np.zeros(20))
+        with patch.object(owtsne, 'affinity_cache',
+                          DiskCache(directory, size_limit=1e8)), \
+                patch.object(owtsne, 'joint_probabilities',
+                             wraps=owtsne.joint_probabilities) as computed:
+            affinities = owtsne.cached_joint_probabilities(data, 5)
+            cached = owtsne.cached_joint_probabilities(data.copy(), 5)
+            self.assertEqual(computed.call_count, 1)
+            np.testing.assert_array_equal(affinities.toarray(),
+                                          cached.toarray())
+
+            owtsne.cached_joint_probabilities(data, 6)
+            self.assertEqual(computed.call_count, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.decomposition import PCA
+
+from Orange.data import ContinuousVariable, DiscreteVariable, Domain, Table
+
+from orangecontrib.single_cell.widgets.pca import pca, randomized_pca
+
+
+class TestPCA(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        latent = rs.randn(300, 5) * [10, 8, 6, 4, 2]
+        x = latent.dot(rs.randn(5, 100)) + rs.randn(300, 100)
+        x[x < 1] = 0
+        self.x = x
+        self.expected = PCA(n_components=5, svd_solver='full').fit(x)
+
+    def assert_components_equal(self, components, expected, **kwargs):
+        # The signs of the components are arbitrary
+        signs = np.sign(np.sum(components * expected, axis=1))
+        np.testing.assert_allclose(components * signs[:, None], expected,
+                                   **kwargs)
+
+    def test_randomized_pca(self):
+        mean, components, variance = randomized_pca(
+            self.x, 5, random_state=0)
+        np.testing.assert_allclose(mean, self.expected.mean_)
+        self.assert_components_equal(
+            components, self.expected.components_, atol=1e-6)
+        np.testing.assert_allclose(
+            variance, self.expected.explained_variance_, rtol=1e-6)
+
+    def test_sparse(self):
+        dense = randomized_pca(self.x, 5, random_state=0)
+        sparse = randomized_pca(sp.csr_matrix(self.x), 5, random_state=0)
+        for expected, result in zip(dense, sparse):
+            np.testing.assert_allclose(result, expected, atol=1e-8)
+
+    def test_float32(self):
+        mean, components, variance = randomized_pca(
+            sp.csr_matrix(self.x), 5, dtype=np.float32, random_state=0)
+        self.assertEqual(components.dtype, np.float32)
+        self.assert_components_equal(
+            components, self.expected.components_, atol=1e-4)
+        np.testing.assert_allclose(
+            variance, self.expected.explained_variance_, rtol=1e-4)
+
+    def test_n_components(self):
+        _, components, _ = randomized_pca(self.x[:3], 5, random_state=0)
+        self.assertEqual(components.shape, (3, 100))
+
+    def test_model(self):
+        table = Table.from_numpy(Domain.from_numpy(self.x),
+                                 sp.csr_matrix(self.x))
+        model = pca(table, 5, random_state=0)
+        projection = model(table)
+        self.assertEqual([var.name for var in projection.domain.attributes],
+                         ['PC1', 'PC2', 'PC3', 'PC4', 'PC5'])
+        expected = self.expected.transform(self.x)
+        signs = np.sign(np.sum(projection.X * expected, axis=0))
+        np.testing.assert_allclose(projection.X * signs, expected, atol=1e-4)
+
+        # Attributes are matched by name
+        order = np.random.RandomState(0).permutation(100)
+        domain = Domain([table.domain.attributes[i] for i in order])
+        np.testing.assert_allclose(
+            model(Table.from_numpy(domain, self.x[:, order])).X,
+            projection.X, atol=1e-8)
+        with self.assertRaises(ValueError):
+            model(Table.from_numpy(Domain(domain.attributes[1:]),
+                                   self.x[:, order[1:]]))
+
+    def test_model_keeps_ids(self):
+        table = Table.from_numpy(Domain.from_numpy(self.x), self.x)
+        projection = pca(table, 5, random_state=0)(table)
+        np.testing.assert_equal(projection.ids, table.ids)
+
+    def test_missing_values(self):
+        x = self.x.copy()
+        rs = np.random.RandomState(1)
+        x[rs.randint(300, size=50), rs.randint(100, size=50)] = np.nan
+        imputed = np.where(np.isnan(x), np.nanmean(x, axis=0), x)
+        expected = randomized_pca(imputed, 5, random_state=0)
+        for data in (x, sp.csr_matrix(x)):
+            result = randomized_pca(data, 5, random_state=0)
+            for values, expected_values in zip(result, expected):
+                np.testing.assert_allclose(values, expected_values, atol=1e-8)
+
+        table = Table.from_numpy(Domain.from_numpy(x), x)
+        model = pca(table, 5, random_state=0)
+        projection = model(table)
+        self.assertFalse(np.isnan(projection.X).any())
+        np.testing.assert_allclose(
+            projection.X,
+            (imputed - expected[0]).dot(expected[1].T), atol=1e-6)
+
+    def test_discrete_attributes(self):
+        color = DiscreteVariable('color', values=('red', 'green', 'blue'))
+        domain = Domain([ContinuousVariable('a'), color])
+        x = np.array([[0, 0], [1, 1], [2, 2], [3, 0], [4, 1]], dtype=float)
+        table = Table.from_numpy(domain, x)
+        model = pca(table, 2, random_state=0)
+        self.assertEqual([var.name for var in model.attributes],
+                         ['a', 'color=red', 'color=green', 'color=blue'])
+        self.assertEqual(model(table).X.shape, (5, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
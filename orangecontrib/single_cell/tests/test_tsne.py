@@ -0,0 +1,88 @@
+import unittest
+
+import numpy as np
+from sklearn.manifold._t_sne import _joint_probabilities_nn
+from sklearn.metrics import silhouette_score
+from sklearn.neighbors import KNeighborsClassifier, NearestNeighbors
+
+from orangecontrib.single_cell.widgets.tsne import TSNEOptimizer, \
+    joint_probabilities, transform, iter_transform
+
+
+def clusters(n_clusters=4, n_points=50, seed=0):
+    rs = np.random.RandomState(seed)
+    x = np.vstack([rs.randn(n_points, 10) + 10 * rs.randn(10)
+                   for _ in range(n_clusters)])
+    return x, np.repeat(np.arange(n_clusters), n_points)
+
+
+class TestTSNE(unittest.TestCase):
+    def setUp(self):
+        self.x, self.y = clusters()
+
+    def test_joint_probabilities(self):
+        perplexity = 10
+        affinities = joint_probabilities(self.x, perplexity)
+        self.assertAlmostEqual(affinities.sum(), 1)
+        self.assertEqual(abs(affinities - affinities.T).max(), 0)
+
+        k = int(3 * perplexity) + 1
+        distances = NearestNeighbors(n_neighbors=k).fit(self.x) \
+            .kneighbors_graph(mode='distance')
+        distances.data **= 2
+        expected = _joint_probabilities_nn(distances, perplexity, 0)
+        np.testing.assert_allclose(affinities.toarray(), expected.toarray(),
+                                   atol=1e-7)
+
+    def test_resume(self):
+        affinities = joint_probabilities(self.x, 10)
+        # Summing the gradient on several threads is not reproducible
+        optimizer = TSNEOptimizer(affinities, random_state=0, n_jobs=1)
+        for _ in range(4):
+            embedding = optimizer.optimize(25)
+        self.assertEqual(optimizer.n_iter, 100)
+
+        self.assertGreater(optimizer.kl_divergence, 0)
+
+        expected = TSNEOptimizer(affinities, random_state=0,
+                                 n_jobs=1).optimize(100)
+        np.testing.assert_equal(embedding, expected)
+        self.assertGreater(silhouette_score(embedding, self.y), 0.5)
+
+    def test_init(self):
+        affinities = joint_probabilities(self.x, 10)
+        init = np.random.RandomState(0).randn(len(self.x), 2)
+        optimizer = TSNEOptimizer(affinities, init=init)
+        np.testing.assert_allclose(optimizer.embedding, init, rtol=1e-6)
+        with self.assertRaises(ValueError):
+            TSNEOptimizer(affinities, init=init[:10])
+        with self.assertRaises(ValueError):
+            TSNEOptimizer(affinities, init='pca')
+
+    def test_transform(self):
+        x, y = clusters(n_points=60)
+        reference, new = x[::2], x[1::2]
+        embedding = TSNEOptimizer(
+            joint_probabilities(reference, 10), early_exaggeration=12,
+            random_state=0).optimize(300)
+        original = embedding.copy()
+
+        progress = []
+        new_embedding = transform(new, reference, embedding, perplexity=10,
+                                  progress_callback=progress.append)
+        self.assertEqual(new_embedding.shape, (len(new), 2))
+        np.testing.assert_equal(embedding, original)
+        self.assertTrue(progress)
+        # New points are placed among the reference points of their cluster
+        classifier = KNeighborsClassifier(5).fit(embedding, y[::2])
+        self.assertGreater(classifier.score(new_embedding, y[1::2]), 0.95)
+
+        steps = list(iter_transform(new, reference, embedding, perplexity=10,
+                                    step=30))
+        self.assertEqual([progress for _, progress in steps],
+                         [0.3, 0.6, 0.9, 1.])
+        np.testing.assert_equal(steps[-1][0], new_embedding)
+
+
+if __name__ == '__main__':
+    unittest.main()
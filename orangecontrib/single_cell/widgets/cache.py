@@ -0,0 +1,273 @@
+"""Persistent cache of expensive results on disk.
+
+Entries are files named by a key computed from the content of the input
+data and the parameters of the computation. Reading an entry marks it as
+recently used; when the files exceed the size limit, the least recently
+used ones are removed.
+
+Failures to read or write the cache are never fatal: a broken entry is
+removed and reported as missing, so the result is simply recomputed.
+Entries are only removed when a new one is stored, never when the cache is
+created.
+
+Widgets check whether their results are still valid for new input with
+`same_content`, which first compares digests of a fixed sample of rows, so
+that changed data is usually recognized without hashing all of it.
+
+"""
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+import scipy.sparse as sp
+
+from Orange.data import Table
+
+# The number of bytes of an array that are hashed at once
+_CHUNK_BYTES = 1 << 24
+# The number of evenly spaced rows that are hashed to tell data apart cheaply
+_SAMPLE_ROWS = 1000
+
+
+def fingerprint(data):
+    """Compute a digest of the content of the data
+
+    Equal digests mean equal values, shapes and types of the data. The
+    digest of a table is that of its `X`; it is computed once and stored on
+    the table, until `X` is replaced or changes its shape. Values of `X`
+    that are changed in place after that are not detected.
+
+    Parameters
+    ----------
+    data : Union[Table, np.ndarray, sp.spmatrix]
+
+    Returns
+    -------
+    str
+
+    """
+    if not isinstance(data, Table):
+        sha = hashlib.sha1()
+        _update(sha, data)
+        return sha.hexdigest()
+
+    x = data.X
+    cached = getattr(data, '_fingerprint', None)
+    if cached is not None and cached[0] is x and cached[1] == x.shape:
+        return cached[2]
+    digest = fingerprint(x)
+    data._fingerprint = x, x.shape, digest
+    return digest
+
+
+def same_content(data1, data2):
+    """Tell whether two tables, arrays or sparse matrices have equal content
+
+    Digests of a fixed sample of rows, which are cheap to compute, tell
+    most different data apart; equality is only concluded from the digests
+    of the entire content, see `fingerprint`.
+
+    Parameters
+    ----------
+    data1, data2 : Union[Table, np.ndarray, sp.spmatrix]
+
+    Returns
+    -------
+    bool
+
+    """
+    return _sample_digest(data1) == _sample_digest(data2) \
+        and fingerprint(data1) == fingerprint(data2)
+
+
+def _sample_digest(data):
+    """Compute a digest of the shape and type of the data, the number of
+    nonzero values in every row of sparse data, and the values of a fixed
+    sample of rows"""
+    if isinstance(data, Table):
+        data = data.X
+    sha = hashlib.sha1()
+    if sp.issparse(data):
+        data = sp.csr_matrix(data)
+        sha.update(repr(('csr', data.shape, data.nnz)).encode())
+        _update_array(sha, data.indptr)
+        sample = data[_sample_rows(data.shape[0])]
+        _update_array(sha, sample.indices)
+        _update_array(sha, sample.data)
+    else:
+        data = np.asarray(data)
+        sha.update(repr(data.shape).encode())
+        if data.ndim:
+            data = data[_sample_rows(len(data))]
+        _update_array(sha, data)
+    return sha.hexdigest()
+
+
+def _sample_rows(n_rows):
+    return np.unique(np.linspace(
+        0, n_rows - 1, min(n_rows, _SAMPLE_ROWS)).astype(int))
+
+
+def cache_key(*parts):
+    """Compute a key from tables, arrays, sparse matrices and other values
+    with a stable `repr`. Data is hashed by its content."""
+    sha = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, Table):
+            sha.update(fingerprint(part).encode())
+        else:
+            _update(sha, part)
+    return sha.hexdigest()
+
+
+def _update(sha, part):
+    if sp.issparse(part):
+        part = sp.csr_matrix(part)
+        sha.update(repr(('csr', part.shape)).encode())
+        for array in (part.data, part.indices, part.indptr):
+            _update_array(sha, array)
+    elif isinstance(part, np.ndarray):
+        _update_array(sha, part)
+    else:
+        sha.update(repr(part).encode())
+
+
+def _update_array(sha, array):
+    """Hash an array in chunks of rows, so that non-contiguous arrays are
+    never copied at once."""
+    sha.update(repr((array.dtype.str, array.shape)).encode())
+    if array.ndim == 0 or array.size == 0:
+        sha.update(np.ascontiguousarray(array).data)
+        return
+    row_bytes = max(1, array[:1].nbytes)
+    step = max(1, _CHUNK_BYTES // row_bytes)
+    for start in range(0, len(array), step):
+        sha.update(np.ascontiguousarray(array[start:start + step]).data)
+
+
+class DiskCache:
+    """A directory of cached results with a size limit
+
+    Parameters
+    ----------
+    directory : str
+    size_limit : int
+        The number of bytes the cached files may take; the least recently
+        used ones are removed when it is exceeded
+
+    Attributes
+    ----------
+    hits, misses : int
+        The numbers of loads that found and did not find an entry
+
+    """
+    def __init__(self, directory, size_limit):
+        self.directory = directory
+        self.size_limit = size_limit
+        self.hits = self.misses = 0
+
+    def load_sparse(self, key):
+        """Return the sparse matrix stored under `key` or None"""
+        return self._load(key, '.npz', lambda path: sp.csr_matrix(
+            sp.load_npz(path)))
+
+    def load_array(self, key):
+        """Return the array stored under `key`, mapped read-only from the
+        file, or None"""
+        return self._load(key, '.npy', lambda path: np.load(
+            path, mmap_mode='r', allow_pickle=False))
+
+    def save_sparse(self, key, matrix):
+        """Store a sparse matrix, compressed, under `key`"""
+        self._store(key, '.npz', lambda f: sp.save_npz(
+            f, sp.csr_matrix(matrix), compressed=True))
+
+    def save_array(self, key, array):
+        """Store a dense array under `key`"""
+        self._store(key, '.npy', lambda f: np.save(
+            f, np.asarray(array), allow_pickle=False))
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            self._remove(path)
+
+    def _load(self, key, suffix, read):
+        path = self._lookup(key, suffix)
+        if path is not None:
+            try:
+                value = read(path)
+            except (OSError, ValueError, zipfile.BadZipFile):
+                self._remove(path)
+            else:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _lookup(self, key, suffix):
+        path = self._path(key, suffix)
+        try:
+            # Mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def _store(self, key, suffix, write):
+        """Write the entry to a temporary file, which is then renamed, so
+        that readers never see partially written entries."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(
+                dir=self.directory, suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                write(f)
+            os.replace(temp_path, self._path(key, suffix))
+        except OSError:
+            self._remove(temp_path)
+            return
+        self._evict()
+
+    def _entries(self):
+        """Return the paths, sizes and access times of the cached files"""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            # Skip the entries that are being written
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        """Remove the least recently used entries above the size limit"""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.size_limit:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -7,7 +7,9 @@ https://sites.google.com/site/findcommunities/
 """
 import random
 
-import networkx as nx
+import numpy as np
+
+from orangecontrib.single_cell.widgets import louvain_csr
 
 __PASS_MAX = -1
 __MIN = 0.0000001
@@ -24,6 +26,7 @@ class Status(object):
     internals = {}
     degrees = {}
     gdegrees = {}
+    modularity = 0.
 
     def __init__(self):
         self.node2com = dict([])
@@ -32,6 +35,7 @@ class Status(object):
         self.gdegrees = dict([])
         self.internals = dict([])
         self.loops = dict([])
+        self.modularity = 0.
 
     def __str__(self):
         return ("node2com : " + str(self.node2com) + " degrees : "
@@ -353,7 +357,7 @@ def generate_dendrogram(graph,
     status.init(current_graph, weight, part_init)
     status_list = list()
     __one_level(current_graph, status, weight, resolution, randomize)
-    new_mod = __modularity(status)
+    new_mod = status.modularity
     partition = __renumber(status.node2com)
     status_list.append(partition)
     mod = new_mod
@@ -362,7 +366,7 @@ def generate_dendrogram(graph,
 
     while True:
         __one_level(current_graph, status, weight, resolution, randomize)
-        new_mod = __modularity(status)
+        new_mod = status.modularity
         if new_mod - mod < __MIN:
             break
         partition = __renumber(status.node2com)
@@ -377,7 +381,9 @@ def induced_graph(partition, graph, weight="weight"):
     """Produce the graph where nodes are the communities
 
     there is a link of weight w between communities if the sum of the weights
-    of the links between their elements is w
+    of the links between their elements is w. The weights are aggregated with
+    a single sparse matrix product, see `louvain_csr.induced_graph`, and the
+    graphs are converted with networkx's sparse matrix conversions.
 
     Parameters
     ----------
@@ -408,17 +414,16 @@ def induced_graph(partition, graph, weight="weight"):
     >>> nx.is_isomorphic(int, goal)
     True
     """
-    ret = nx.Graph()
-    ret.add_nodes_from(partition.values())
-
-    for node1, node2, datas in graph.edges(data=True):
-        edge_weight = datas.get(weight, 1)
-        com1 = partition[node1]
-        com2 = partition[node2]
-        w_prec = ret.get_edge_data(com1, com2, {weight: 0}).get(weight, 1)
-        ret.add_edge(com1, com2, **{weight: w_prec + edge_weight})
+    nodes = list(graph.nodes())
+    communities = list(dict.fromkeys(partition.values()))
+    com_index = {com: idx for idx, com in enumerate(communities)}
+    labels = np.fromiter((com_index[partition[node]] for node in nodes),
+                         dtype=int, count=len(nodes))
 
-    return ret
+    adjacency = louvain_csr.graph_to_adjacency(graph, weight)
+    induced = louvain_csr.induced_graph(labels, adjacency)
+    return louvain_csr.adjacency_to_graph(induced, nodes=communities,
+                                          weight=weight)
 
 
 def __renumber(dictionary):
@@ -455,7 +460,9 @@ def __one_level(graph, status, weight_key, resolution, randomize):
     """
     modified = True
     nb_pass_done = 0
-    cur_mod = __modularity(status)
+    # Computed once per level, then kept up to date by __remove and __insert
+    status.modularity = __modularity(status)
+    cur_mod = status.modularity
     new_mod = cur_mod
 
     while modified and nb_pass_done != __PASS_MAX:
@@ -482,7 +489,7 @@ def __one_level(graph, status, weight_key, resolution, randomize):
                      neigh_communities.get(best_com, 0.), status)
             if best_com != com_node:
                 modified = True
-        new_mod = __modularity(status)
+        new_mod = status.modularity
         if new_mod - cur_mod < __MIN:
             break
 
@@ -502,22 +509,33 @@ def __neighcom(node, graph, status, weight_key):
     return weights
 
 
+def __community_modularity(com, status):
+    """The contribution of community com to the modularity"""
+    links = float(status.total_weight)
+    return (status.internals.get(com, 0.) / links -
+            (status.degrees.get(com, 0.) / (2. * links)) ** 2)
+
+
 def __remove(node, com, weight, status):
     """ Remove node from community com and modify status"""
+    status.modularity -= __community_modularity(com, status)
     status.degrees[com] = (status.degrees.get(com, 0.)
                            - status.gdegrees.get(node, 0.))
     status.internals[com] = float(status.internals.get(com, 0.) -
                                   weight - status.loops.get(node, 0.))
+    status.modularity += __community_modularity(com, status)
     status.node2com[node] = -1
 
 
 def __insert(node, com, weight, status):
     """ Insert node into community and modify status"""
     status.node2com[node] = com
+    status.modularity -= __community_modularity(com, status)
     status.degrees[com] = (status.degrees.get(com, 0.) +
                            status.gdegrees.get(node, 0.))
     status.internals[com] = float(status.internals.get(com, 0.) +
                                   weight + status.loops.get(node, 0.))
+    status.modularity += __community_modularity(com, status)
 
 
 def __modularity(status):
@@ -0,0 +1,1233 @@
+"""Louvain clustering on sparse adjacency matrices.
+
+Array-backed counterpart of :mod:`louvain`. The graph is given as a
+symmetric ``scipy.sparse`` adjacency matrix and the state of the algorithm
+(community labels, community degree totals and internal weights) is kept in
+contiguous NumPy arrays instead of Python dictionaries, which keeps memory
+usage proportional to the number of edges and avoids walking networkx
+adjacency dicts.
+
+The adjacency matrix follows the networkx convention: a self-loop of weight
+`w` is stored as `w` on the diagonal and contributes `2w` to the node degree.
+
+"""
+import multiprocessing
+import signal
+from collections import deque, namedtuple
+from concurrent.futures import CancelledError
+from functools import partial
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from sklearn.utils import check_random_state
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:  # Python < 3.8
+    SharedMemory = None
+
+_PASS_MAX = -1
+_MIN = 0.0000001
+# The number of nodes moved between progress reports and cancellation checks
+_BATCH_SIZE = 1000
+# How often, in seconds, a worker process is checked for cancellation
+_POLL_INTERVAL = 0.1
+# How long, in seconds, a cancelled worker process may take to clean up
+# before it is terminated
+_STOP_TIMEOUT = 1.
+# Worker processes are started from GUI worker threads, which must not fork.
+# A fork server, where available, starts them without re-importing modules.
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    _CONTEXT = multiprocessing.get_context('forkserver')
+    _CONTEXT.set_forkserver_preload([__name__])
+else:
+    _CONTEXT = multiprocessing.get_context('spawn')
+
+SweepResult = namedtuple(
+    'SweepResult', ['resolution', 'partition', 'modularity', 'n_clusters'])
+
+
+class Status:
+    """Community state of a graph, kept in arrays indexed by node and by
+    community.
+
+    Parameters
+    ----------
+    adjacency : sp.csr_matrix
+        The adjacency matrix with self-loops counted twice on the diagonal,
+        so that row sums equal the node degrees.
+    part : Optional[np.ndarray]
+        Initial community labels; every node in its own community if None.
+
+    """
+    def __init__(self, adjacency, part=None):
+        n_nodes = adjacency.shape[0]
+        # Neighbourhoods exclude self-loops, which are tracked in `loops`
+        offdiag = sp.csr_matrix(adjacency - sp.diags(adjacency.diagonal()))
+        offdiag.eliminate_zeros()
+        offdiag.sort_indices()
+        self.indptr = offdiag.indptr
+        self.indices = offdiag.indices
+        self.weights = offdiag.data
+
+        self.gdegrees = np.asarray(adjacency.sum(axis=1), dtype=float).ravel()
+        self.loops = adjacency.diagonal().astype(float) / 2
+        self.total_weight = float(self.gdegrees.sum() / 2)
+
+        if part is None:
+            self.node2com = np.arange(n_nodes)
+        else:
+            self.node2com = _renumber(np.asarray(part))
+
+        self.degrees = np.bincount(
+            self.node2com, weights=self.gdegrees, minlength=n_nodes)
+
+        # Internal weights count every undirected edge once; as each edge is
+        # stored twice (and each loop twice on the diagonal) we halve them
+        coo = adjacency.tocoo()
+        rows, cols = self.node2com[coo.row], self.node2com[coo.col]
+        mask = rows == cols
+        self.internals = np.bincount(
+            rows[mask], weights=coo.data[mask] / 2, minlength=n_nodes)
+
+        # The modularity is computed once and then kept up to date with the
+        # changes of every moved community in `_remove` and `_insert`
+        self.modularity = _modularity(self)
+
+    def __str__(self):
+        return ("node2com : " + str(self.node2com) + " degrees : "
+                + str(self.degrees) + " internals : " + str(self.internals)
+                + " total_weight : " + str(self.total_weight))
+
+
+class _Monitor:
+    """Report the progress of the passes over nodes and stop the computation
+    when cancelled.
+
+    The number of passes is not known in advance, so every pass covers half
+    of the remaining progress.
+    """
+    def __init__(self, progress_callback=None, cancel_token=None):
+        self.progress_callback = progress_callback
+        self.cancel_token = cancel_token
+        self.passes = 0
+
+    def check_cancelled(self):
+        if self.cancel_token is not None and self.cancel_token.is_set():
+            raise CancelledError()
+
+    def check(self, done, total):
+        """Called after `done` of `total` nodes of the current pass"""
+        self.check_cancelled()
+        if self.progress_callback is not None:
+            self.progress_callback(1 - 0.5 ** (self.passes + done / total))
+
+    def end_pass(self):
+        self.passes += 1
+
+
+def graph_to_adjacency(graph, weight='weight'):
+    """Convert a networkx graph to a sparse adjacency matrix.
+
+    Rows and columns follow the order of `graph.nodes()`.
+
+    Parameters
+    ----------
+    graph : nx.Graph
+    weight : str, optional
+        The edge attribute to use as weight. Default to 'weight'
+
+    Returns
+    -------
+    sp.csr_matrix
+
+    """
+    if graph.is_directed():
+        raise TypeError("Bad graph type, use only non directed graph")
+    if not len(graph):
+        return sp.csr_matrix((0, 0))
+    # networkx also stores self-loops once, on the diagonal
+    return sp.csr_matrix(_to_scipy_sparse(graph, dtype=float, weight=weight))
+
+
+def _as_adjacency(graph):
+    """Return the internal representation of a graph, a sparse CSR matrix
+    with sorted indices and self-loops counted twice on the diagonal."""
+    if isinstance(graph, nx.Graph):
+        graph = graph_to_adjacency(graph)
+    if not sp.issparse(graph):
+        raise TypeError("Bad graph type ({})".format(type(graph)))
+    if graph.shape[0] != graph.shape[1]:
+        raise ValueError("The adjacency matrix must be square")
+
+    adjacency = sp.csr_matrix(graph, dtype=float)
+    if adjacency.nnz and adjacency.data.min() < 0:
+        raise ValueError("Bad graph type, negative edge weights")
+    adjacency = adjacency + sp.diags(adjacency.diagonal())
+    adjacency.sort_indices()
+    return adjacency
+
+
+def partition_at_level(dendrogram, level):
+    """Return the partition of the nodes at the given level
+
+    Parameters
+    ----------
+    dendrogram : list of np.ndarray
+       a list of partitions, where the i+1-th maps the communities of the
+       i-th to its communities.
+    level : int
+       the level which belongs to [0..len(dendrogram)-1]
+
+    Returns
+    -------
+    partition : np.ndarray
+       The community label of every node
+
+    """
+    partition = dendrogram[0].copy()
+    for index in range(1, level + 1):
+        partition = dendrogram[index][partition]
+    return partition
+
+
+def modularity(partition, graph):
+    """Compute the modularity of a partition of a graph
+
+    Parameters
+    ----------
+    partition : array_like
+       the community label of every node
+    graph : Union[sp.spmatrix, nx.Graph]
+       the graph which is decomposed
+
+    Returns
+    -------
+    modularity : float
+
+    Raises
+    ------
+    ValueError
+        If the graph has no link
+
+    """
+    return modularity_scores(_renumber(np.asarray(partition)), graph)
+
+
+def modularity_scores(partitions, graph, resolution=1.,
+                      return_contributions=False):
+    """Compute the modularity of one or many partitions of a graph at once
+
+    All partitions are scored in a single pass over the links of the graph,
+    so comparing many clusterings of the same graph costs little more than
+    scoring a single one.
+
+    Parameters
+    ----------
+    partitions : array_like
+       non-negative integer community labels of every node, either a single
+       labelling of shape (n_nodes,) or a stack of shape
+       (n_partitions, n_nodes)
+    graph : Union[sp.spmatrix, nx.Graph]
+       the graph which is decomposed
+    resolution :  double, optional
+        The weight of the expected internal links, default to 1.
+    return_contributions : bool, optional
+        Also return the contribution of every community to the modularity
+
+    Returns
+    -------
+    scores : Union[float, np.ndarray]
+        The modularity of the partition, or an array with the modularity of
+        each partition in the stack
+    contributions : np.ndarray
+        Only if `return_contributions`; the contribution of community `c` is
+        at index `c` (of each row for a stack) and is zero for labels that
+        are not used
+
+    Raises
+    ------
+    ValueError
+        If the graph has no link or the labels are not non-negative integers
+
+    """
+    adjacency = _as_adjacency(graph)
+    if adjacency.nnz == 0:
+        raise ValueError("A graph without link has an undefined modularity")
+
+    labels = np.asarray(partitions)
+    single = labels.ndim == 1
+    labels = np.atleast_2d(labels)
+    if labels.ndim != 2 or labels.shape[1] != adjacency.shape[0]:
+        raise ValueError("Partitions must label every node of the graph")
+    if labels.size and (not np.issubdtype(labels.dtype, np.integer)
+                        or labels.min() < 0):
+        raise ValueError("Community labels must be non-negative integers")
+
+    # Give every partition its own range of bins, so that one bincount
+    # accumulates the totals of all of them
+    n_partitions = labels.shape[0]
+    n_labels = int(labels.max()) + 1 if labels.size else 0
+    bins = labels + (np.arange(n_partitions) * n_labels)[:, None]
+    size = n_partitions * n_labels
+
+    coo = adjacency.tocoo()
+    internal = np.where(labels[:, coo.row] == labels[:, coo.col],
+                        coo.data, 0.)
+    # Self-loops are doubled on the diagonal, hence each link counts twice
+    internals = np.bincount(bins[:, coo.row].ravel(), weights=internal.ravel(),
+                            minlength=size) / 2
+    gdegrees = np.asarray(adjacency.sum(axis=1), dtype=float).ravel()
+    degrees = np.bincount(bins.ravel(), weights=np.tile(gdegrees, n_partitions),
+                          minlength=size)
+
+    links = gdegrees.sum() / 2
+    contributions = (internals / links
+                     - resolution * (degrees / (2. * links)) ** 2)
+    contributions = contributions.reshape(n_partitions, n_labels)
+    scores = contributions.sum(axis=1)
+    if single:
+        scores, contributions = float(scores[0]), contributions[0]
+    if return_contributions:
+        return scores, contributions
+    return scores
+
+
+def best_partition(graph, partition=None, resolution=1., randomize=False,
+                   random_state=None, method='louvain', progress_callback=None,
+                   cancel_token=None):
+    """Compute the partition of the graph nodes which maximises the modularity
+    (or try..) using the Louvain heuristices
+
+    This is the partition of highest modularity, i.e. the highest partition
+    of the dendrogram generated by the Louvain algorithm.
+
+    Parameters
+    ----------
+    graph : Union[sp.spmatrix, nx.Graph]
+       the symmetric adjacency matrix of the graph which is decomposed
+    partition : array_like, optional
+       the algorithm will start using this partition of the nodes.
+    resolution :  double, optional
+        Will change the size of the communities, default to 1.
+    randomize :  boolean, optional
+        Will randomize the node evaluation order and the community evaluation
+        order to get different partitions at each call
+    random_state : Optional[Union[int, np.random.RandomState]]
+        The seed used when `randomize` is set
+    method : str, optional
+        'louvain' or 'leiden', see `leiden_partition`. Default to 'louvain'
+    progress_callback : Optional[Callable[[float], None]]
+        Called with the estimated progress between batches of moved nodes
+    cancel_token : Optional[threading.Event]
+        When set, the computation stops with `CancelledError` within a batch
+        of moved nodes
+
+    Returns
+    -------
+    partition : np.ndarray
+       The community label of every node, numbered from 0 to number of
+       communities
+
+    See Also
+    --------
+    louvain.best_partition
+
+    """
+    if method == 'leiden':
+        return leiden_partition(
+            graph, partition, resolution, randomize, random_state,
+            progress_callback=progress_callback, cancel_token=cancel_token)
+    elif method != 'louvain':
+        raise ValueError("Unknown method '{}'".format(method))
+
+    dendo = generate_dendrogram(
+        graph, partition, resolution, randomize, random_state,
+        progress_callback=progress_callback, cancel_token=cancel_token)
+    return partition_at_level(dendo, len(dendo) - 1)
+
+
+def generate_dendrogram(graph, part_init=None, resolution=1., randomize=False,
+                        random_state=None, return_modularity=False,
+                        progress_callback=None, cancel_token=None):
+    """Find communities in the graph and return the associated dendrogram
+
+    Parameters
+    ----------
+    graph : Union[sp.spmatrix, nx.Graph]
+        the symmetric adjacency matrix of the graph which will be decomposed
+    part_init : array_like, optional
+        the algorithm will start using this partition of the nodes
+    resolution :  double, optional
+        Will change the size of the communities, default to 1.
+    randomize :  boolean, optional
+        Will randomize the node evaluation order and the community evaluation
+        order to get different partitions at each call
+    random_state : Optional[Union[int, np.random.RandomState]]
+        The seed used when `randomize` is set
+    return_modularity : boolean, optional
+        Also return the modularity of the partition at each level
+    progress_callback : Optional[Callable[[float], None]]
+        Called with the estimated progress between batches of moved nodes
+    cancel_token : Optional[threading.Event]
+        When set, the computation stops with `CancelledError` within a batch
+        of moved nodes
+
+    Returns
+    -------
+    dendrogram : list of np.ndarray
+        a list of partitions, where the i+1-th maps the communities of the
+        i-th to its communities and the first maps the nodes of the graph
+    modularities : list of float
+        the modularity at each level, only if `return_modularity` is set
+
+    Raises
+    ------
+    CancelledError
+        If `cancel_token` was set
+
+    See Also
+    --------
+    louvain.generate_dendrogram
+
+    """
+    adjacency = _as_adjacency(graph)
+    random_state = check_random_state(random_state) if randomize else None
+    monitor = _Monitor(progress_callback, cancel_token)
+
+    # special case, when there is no link
+    # the best partition is everyone in its community
+    if adjacency.nnz == 0:
+        status_list, mod_list = [np.arange(adjacency.shape[0])], [0.]
+        return (status_list, mod_list) if return_modularity else status_list
+
+    status = Status(adjacency, part_init)
+    status_list, mod_list = list(), list()
+    _one_level(status, resolution, random_state, monitor)
+    new_mod = status.modularity
+    partition = _renumber(status.node2com)
+    status_list.append(partition)
+    mod_list.append(new_mod)
+    mod = new_mod
+    adjacency = _induced_adjacency(partition, adjacency)
+    status = Status(adjacency)
+
+    while True:
+        _one_level(status, resolution, random_state, monitor)
+        new_mod = status.modularity
+        if new_mod - mod < _MIN:
+            break
+        partition = _renumber(status.node2com)
+        status_list.append(partition)
+        mod_list.append(new_mod)
+        mod = new_mod
+        adjacency = _induced_adjacency(partition, adjacency)
+        status = Status(adjacency)
+    if return_modularity:
+        return status_list[:], mod_list[:]
+    return status_list[:]
+
+
+def partition_sweep(graph, resolutions, method='louvain', n_jobs=None,
+                    cancel_token=None, **kwargs):
+    """Compute the best partition of the graph at each of the resolutions
+
+    The adjacency matrix is built once and shared with the worker processes,
+    which partition the resolutions in parallel.
+
+    Parameters
+    ----------
+    graph : Union[sp.spmatrix, nx.Graph]
+       the symmetric adjacency matrix of the graph which is decomposed
+    resolutions : Iterable[float]
+    method : str, optional
+        'louvain' or 'leiden'. Default to 'louvain'
+    n_jobs : Optional[int]
+        The number of worker processes, all processors if None. With a single
+        job the partitions are computed in the calling process.
+    cancel_token : Optional[threading.Event]
+        When set, the worker processes are terminated
+    kwargs
+        Passed to `best_partition`
+
+    Returns
+    -------
+    List[SweepResult]
+        The partition, its modularity and the number of clusters for each
+        resolution, in the order of `resolutions`
+
+    """
+    if isinstance(graph, nx.Graph):
+        graph = graph_to_adjacency(graph)
+    resolutions = list(resolutions)
+    task = partial(_sweep_task, method=method, **kwargs)
+    partitions = _map_on_graph(task, resolutions, graph, n_jobs,
+                               cancel_token)
+    if not partitions:
+        return []
+    scores = modularity_scores(np.vstack(partitions), graph)
+    return [SweepResult(resolution, partition, score, partition.max() + 1)
+            for resolution, partition, score
+            in zip(resolutions, partitions, scores.tolist())]
+
+
+def ensemble_partition(graph, n_runs=10, resolution=1., method='louvain',
+                       n_jobs=None, random_state=None, cancel_token=None):
+    """Compute a consensus partition of randomized runs and the stability
+    of every node's assignment
+
+    The graph is partitioned `n_runs` times with randomized node orders in
+    worker processes that share the adjacency matrix. Each link of the graph
+    is then weighted by the fraction of runs that put its nodes into the same
+    community, and this co-assignment graph is partitioned once more to
+    obtain the consensus.
+
+    Parameters
+    ----------
+    graph : Union[sp.spmatrix, nx.Graph]
+       the symmetric adjacency matrix of the graph which is decomposed
+    n_runs : int, optional
+        The number of randomized runs. Default to 10
+    resolution :  double, optional
+        Will change the size of the communities, default to 1.
+    method : str, optional
+        'louvain' or 'leiden'. Default to 'louvain'
+    n_jobs : Optional[int]
+        The number of worker processes, all processors if None
+    random_state : Optional[Union[int, np.random.RandomState]]
+        The seed from which the seeds of the runs are drawn
+    cancel_token : Optional[threading.Event]
+        When set, the worker processes are terminated
+
+    Returns
+    -------
+    partition : np.ndarray
+        The consensus community label of every node
+    stability : np.ndarray
+        The fraction of runs in which each node was assigned to the community
+        that mostly corresponds to its consensus community
+
+    """
+    if isinstance(graph, nx.Graph):
+        graph = graph_to_adjacency(graph)
+    adjacency = sp.csr_matrix(graph, dtype=float)
+
+    seeds = check_random_state(random_state).randint(
+        np.iinfo(np.int32).max, size=n_runs)
+    task = partial(_ensemble_task, resolution=resolution, method=method)
+    runs = np.array(_map_on_graph(task, seeds.tolist(), adjacency, n_jobs,
+                                  cancel_token))
+
+    # Weight each link by the fraction of runs that co-assign its nodes
+    coo = sp.triu(adjacency, k=1).tocoo()
+    coassignment = np.mean(runs[:, coo.row] == runs[:, coo.col], axis=0)
+    mask = coassignment > 0
+    consensus_graph = sp.coo_matrix(
+        (coassignment[mask], (coo.row[mask], coo.col[mask])),
+        shape=adjacency.shape)
+    consensus_graph = (consensus_graph + consensus_graph.T).tocsr()
+    partition = best_partition(consensus_graph, method=method,
+                               random_state=random_state,
+                               cancel_token=cancel_token)
+
+    # Match every community of a run to the consensus community it overlaps
+    # most, and count how often each node ends up in its consensus community
+    n_communities = partition.max() + 1
+    agreement = np.zeros(len(partition))
+    for labels in runs:
+        overlap = sp.csr_matrix(
+            (np.ones(len(labels)), (labels, partition)),
+            shape=(labels.max() + 1, n_communities))
+        matched = np.asarray(overlap.argmax(axis=1)).ravel()
+        agreement += matched[labels] == partition
+    return partition, agreement / n_runs
+
+
+def _map_on_graph(task, args, graph, n_jobs, cancel_token=None):
+    """Map `task` over `args` in worker processes that find the adjacency
+    matrix of the graph in `_worker_adjacency`."""
+    if isinstance(graph, nx.Graph):
+        graph = graph_to_adjacency(graph)
+    adjacency = sp.csr_matrix(graph, dtype=float)
+
+    if n_jobs == 1 or len(args) < 2:
+        _attach_adjacency(None, adjacency)
+        try:
+            results = []
+            for arg in args:
+                _check_cancelled(cancel_token)
+                results.append(task(arg))
+            return results
+        finally:
+            _attach_adjacency(None, None)
+
+    blocks, shared = _share_adjacency(adjacency)
+    try:
+        pool = _CONTEXT.Pool(n_jobs, initializer=_attach_adjacency,
+                             initargs=(shared,))
+        try:
+            result = pool.map_async(task, args)
+            while not result.ready():
+                _check_cancelled(cancel_token)
+                result.wait(_POLL_INTERVAL)
+            return result.get()
+        finally:
+            # Stop the workers explicitly, also those of cancelled tasks
+            pool.terminate()
+            pool.join()
+    finally:
+        _release(blocks)
+
+
+def _check_cancelled(cancel_token):
+    if cancel_token is not None and cancel_token.is_set():
+        raise CancelledError()
+
+
+def run_in_process(function, graph, progress_callback=None,
+                   cancel_token=None, **kwargs):
+    """Call a partitioning function on the graph in a worker process
+
+    Running the pure Python optimisation in a separate process keeps the
+    calling process, e.g. the GUI, responsive. The adjacency matrix is
+    passed to the worker and the arrays of the result are passed back
+    through shared memory instead of being pickled, where shared memory is
+    available (Python 3.8 and later).
+
+    Parameters
+    ----------
+    function : Callable
+        A module level function that takes the graph as the first argument,
+        e.g. `generate_dendrogram` or `best_partition`
+    graph : Union[sp.spmatrix, nx.Graph]
+    progress_callback : Callable[[float], None]
+        If given, the function is called with a progress callback whose
+        reports are forwarded to this one
+    cancel_token : Optional[threading.Event]
+        When set, the worker process is asked to stop, so that it shuts down
+        the processes it started itself, e.g. those of `ensemble_partition`,
+        and releases its shared memory. It is terminated if it does not stop
+        in time.
+    kwargs
+        Passed to `function`, which must accept a `cancel_token`
+
+    Returns
+    -------
+    The result of `function`
+
+    Raises
+    ------
+    CancelledError
+        If the computation is cancelled
+
+    """
+    if isinstance(graph, nx.Graph):
+        graph = graph_to_adjacency(graph)
+    adjacency = sp.csr_matrix(graph, dtype=float)
+
+    blocks, shared = _share_adjacency(adjacency)
+    stop = _CONTEXT.Event()
+    connection, worker_connection = _CONTEXT.Pipe(duplex=False)
+    process = _CONTEXT.Process(
+        target=_process_task,
+        args=(worker_connection, shared, stop, function, kwargs,
+              progress_callback is not None))
+    try:
+        process.start()
+        worker_connection.close()
+        while True:
+            _check_cancelled(cancel_token)
+            if not connection.poll(_POLL_INTERVAL):
+                if not process.is_alive() and not connection.poll():
+                    raise RuntimeError("The worker process exited unexpectedly")
+                continue
+            kind, value = connection.recv()
+            if kind == 'progress':
+                progress_callback(value)
+            elif kind == 'error':
+                raise value
+            else:
+                return _unshare(value)
+    finally:
+        # Terminating the process skips its clean-up on Windows, so it is
+        # first asked to stop
+        stop.set()
+        process.join(_STOP_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        # Release the shared arrays of a result that was not received
+        try:
+            while connection.poll():
+                kind, value = connection.recv()
+                if kind == 'result':
+                    _unshare(value)
+        except EOFError:
+            pass
+        connection.close()
+        _release(blocks)
+
+
+def _process_task(connection, shared, stop, function, kwargs,
+                  report_progress):
+    """Run `function` on the shared adjacency and send the progress and the
+    result, with arrays in shared memory, through the connection."""
+    signal.signal(signal.SIGTERM, _terminate_task)
+    _attach_adjacency(shared)
+    kwargs['cancel_token'] = stop
+    if report_progress:
+        kwargs['progress_callback'] = \
+            lambda progress: connection.send(('progress', progress))
+    try:
+        result = function(_worker_adjacency, **kwargs)
+    except Exception as ex:  # pylint: disable=broad-except
+        connection.send(('error', ex))
+    else:
+        # The matrix is passed as is when the caller has no shared memory
+        if not sp.issparse(shared):
+            result = _share(result)
+        connection.send(('result', result))
+    finally:
+        connection.close()
+
+
+def _terminate_task(_signum, _frame):
+    """Handle the termination of a task process started by `run_in_process`
+
+    The worker processes of the task are terminated and `SystemExit` is
+    raised, so that the task's `finally` clauses shut down its process pools
+    and unlink their shared memory. Windows terminates processes without
+    signals, so there the task is only asked to stop.
+    """
+    for child in multiprocessing.active_children():
+        child.terminate()
+    raise SystemExit(1)
+
+
+def _share_array(array):
+    """Copy an array to a new shared memory block and return the block with
+    the description from which the array can be attached."""
+    block = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _share_adjacency(adjacency):
+    """Put the arrays of the matrix into shared memory and return the blocks
+    and the description of the matrix for `_attach_adjacency`. Without
+    shared memory the matrix itself is returned, to be pickled."""
+    if SharedMemory is None:
+        return [], adjacency
+    blocks, specs = [], []
+    try:
+        for array in (adjacency.data, adjacency.indices, adjacency.indptr):
+            block, spec = _share_array(array)
+            blocks.append(block)
+            specs.append(spec)
+    except Exception:
+        _release(blocks)
+        raise
+    return blocks, (specs, adjacency.shape)
+
+
+def _release(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+class _SharedArray(namedtuple('_SharedArray', ['spec'])):
+    """A result array that was moved to shared memory"""
+
+
+def _share(result):
+    """Replace the arrays in a (nested) result with shared copies. The
+    blocks are released by the receiver in `_unshare`."""
+    if isinstance(result, np.ndarray):
+        block, spec = _share_array(result)
+        block.close()
+        return _SharedArray(spec)
+    if isinstance(result, (list, tuple)):
+        return _rebuild(result, [_share(item) for item in result])
+    return result
+
+
+def _unshare(result):
+    """Copy the shared arrays of a result into process memory and release
+    their blocks."""
+    if isinstance(result, _SharedArray):
+        name, shape, dtype = result.spec
+        block = SharedMemory(name=name)
+        try:
+            return np.ndarray(shape, dtype, buffer=block.buf).copy()
+        finally:
+            _release([block])
+    if isinstance(result, (list, tuple)):
+        return _rebuild(result, [_unshare(item) for item in result])
+    return result
+
+
+def _rebuild(sequence, items):
+    """Construct a list, tuple or named tuple like `sequence` from `items`"""
+    if hasattr(sequence, '_fields'):
+        return type(sequence)(*items)
+    return type(sequence)(items)
+
+
+_worker_adjacency = None
+_worker_blocks = []
+
+
+def _attach_adjacency(shared, adjacency=None):
+    """Set the adjacency matrix used by the tasks in this process, either
+    directly or from the shared memory blocks described in `shared`."""
+    global _worker_adjacency, _worker_blocks
+    if sp.issparse(shared):
+        adjacency = shared
+    elif shared is not None:
+        specs, shape = shared
+        _worker_blocks = [SharedMemory(name=name) for name, _, _ in specs]
+        data, indices, indptr = [
+            np.ndarray(array_shape, dtype, buffer=block.buf)
+            for block, (_, array_shape, dtype) in zip(_worker_blocks, specs)]
+        adjacency = sp.csr_matrix((data, indices, indptr), shape=shape,
+                                  copy=False)
+    _worker_adjacency = adjacency
+
+
+def _sweep_task(resolution, method, **kwargs):
+    return best_partition(_worker_adjacency, resolution=resolution,
+                          method=method, **kwargs)
+
+
+def _ensemble_task(seed, resolution, method):
+    return best_partition(_worker_adjacency, resolution=resolution,
+                          randomize=True, random_state=seed, method=method)
+
+
+def leiden_partition(graph, partition=None, resolution=1., randomize=False,
+                     random_state=None, theta=0.01, progress_callback=None,
+                     cancel_token=None):
+    """Compute the partition of the graph nodes which maximises the modularity
+    using the Leiden algorithm
+
+    Compared to Louvain, the local moving phase only revisits the nodes whose
+    neighbourhood changed, and a refinement phase splits each community into
+    well connected subcommunities before the graph is aggregated, so the
+    resulting communities are guaranteed to be connected.
+
+    Parameters
+    ----------
+    graph : Union[sp.spmatrix, nx.Graph]
+       the symmetric adjacency matrix of the graph which is decomposed
+    partition : array_like, optional
+       the algorithm will start using this partition of the nodes.
+    resolution :  double, optional
+        Will change the size of the communities, default to 1.
+    randomize :  boolean, optional
+        Will randomize the node evaluation order and the choice of
+        subcommunities during refinement; otherwise the result is
+        deterministic
+    random_state : Optional[Union[int, np.random.RandomState]]
+        The seed used when `randomize` is set
+    theta : float, optional
+        The randomness in the choice of subcommunities during randomized
+        refinement; the subcommunity with the highest gain is always chosen
+        if 0 or if `randomize` is not set
+    progress_callback : Optional[Callable[[float], None]]
+        Called with the estimated progress between batches of moved nodes
+    cancel_token : Optional[threading.Event]
+        When set, the computation stops with `CancelledError` within a batch
+        of moved nodes
+
+    Returns
+    -------
+    partition : np.ndarray
+       The community label of every node, numbered from 0 to number of
+       communities
+
+    References
+    ----------
+    .. 1. Traag, V.A., Waltman, L. & van Eck, N.J. From Louvain to Leiden:
+    guaranteeing well-connected communities. Sci Rep 9, 5233 (2019).
+
+    """
+    adjacency = _as_adjacency(graph)
+    random_state = check_random_state(random_state) if randomize else None
+    monitor = _Monitor(progress_callback, cancel_token)
+
+    if adjacency.nnz == 0:
+        return np.arange(adjacency.shape[0])
+
+    # The aggregate node every original node belongs to
+    node2agg = np.arange(adjacency.shape[0])
+    status = Status(adjacency, partition)
+
+    while True:
+        _fast_local_moving(status, resolution, random_state, monitor)
+        partition = _renumber(status.node2com)
+        n_nodes, n_communities = len(partition), partition.max() + 1
+        if n_communities == n_nodes:
+            break
+
+        refined = _renumber(
+            _refine(status, partition, resolution, random_state, theta,
+                    monitor))
+        # When refinement cannot merge anything, aggregate by communities
+        if refined.max() + 1 == n_nodes:
+            refined = partition
+
+        # Aggregate by the refined partition, but start from the communities
+        agg_partition = np.empty(refined.max() + 1, dtype=int)
+        agg_partition[refined] = partition
+        node2agg = refined[node2agg]
+        adjacency = _induced_adjacency(refined, adjacency)
+        status = Status(adjacency, agg_partition)
+
+    return _renumber(partition[node2agg])
+
+
+def induced_graph(partition, graph):
+    """Produce the graph where nodes are the communities
+
+    There is a link of weight w between communities if the sum of the weights
+    of the links between their elements is w. The community graph is computed
+    as a single sparse product P^T A P, where P is the membership indicator
+    matrix of the partition.
+
+    Parameters
+    ----------
+    partition : array_like
+       the community label of every node, numbered from 0 to the number of
+       communities
+    graph : Union[sp.spmatrix, nx.Graph]
+        the initial graph
+
+    Returns
+    -------
+    sp.csr_matrix
+       the adjacency matrix of the graph where nodes are the communities
+
+    See Also
+    --------
+    adjacency_to_graph to convert the result to a networkx graph
+
+    """
+    induced = _induced_adjacency(np.asarray(partition), _as_adjacency(graph))
+    # Store self-loops once, as they are in the input graph
+    return sp.csr_matrix(induced - sp.diags(induced.diagonal() / 2))
+
+
+def adjacency_to_graph(adjacency, nodes=None, weight='weight'):
+    """Convert a sparse adjacency matrix to a networkx graph.
+
+    Parameters
+    ----------
+    adjacency : sp.spmatrix
+    nodes : Optional[list]
+        The node labels of the rows; default to 0..n-1
+    weight : str, optional
+        The edge attribute to store the weights in. Default to 'weight'
+
+    Returns
+    -------
+    nx.Graph
+
+    """
+    graph = _from_scipy_sparse(sp.csr_matrix(adjacency),
+                               edge_attribute=weight)
+    if nodes is not None:
+        nodes = list(nodes)
+        if nodes != list(range(len(nodes))):
+            graph = nx.relabel_nodes(graph, dict(enumerate(nodes)))
+    return graph
+
+
+# networkx 2.7 added conversions of sparse arrays, and 3.0 removed those of
+# sparse matrices
+_to_scipy_sparse = getattr(nx, 'to_scipy_sparse_array', None) \
+    or nx.to_scipy_sparse_matrix
+_from_scipy_sparse = getattr(nx, 'from_scipy_sparse_array', None) \
+    or nx.from_scipy_sparse_matrix
+
+
+def _membership_matrix(partition):
+    """Return the indicator matrix P with P[i, c] = 1 if node i belongs to
+    community c."""
+    n_nodes, n_communities = len(partition), partition.max() + 1
+    return sp.csr_matrix(
+        (np.ones(n_nodes), (np.arange(n_nodes), partition)),
+        shape=(n_nodes, n_communities))
+
+
+def _induced_adjacency(partition, adjacency):
+    """Produce the adjacency matrix of the graph where nodes are the
+    communities. Self-loops stay counted twice on the diagonal."""
+    membership = _membership_matrix(partition)
+    induced = sp.csr_matrix(membership.T.dot(adjacency).dot(membership))
+    induced.sort_indices()
+    return induced
+
+
+def _renumber(labels):
+    """Renumber the labels from 0 to n in the order of first appearance."""
+    _, first, inverse = np.unique(labels, return_index=True,
+                                  return_inverse=True)
+    new_values = np.empty(len(first), dtype=int)
+    new_values[np.argsort(first)] = np.arange(len(first))
+    return new_values[inverse.ravel()]
+
+
+def _node_order(n_nodes, random_state):
+    if random_state is not None:
+        return random_state.permutation(n_nodes)
+    return range(n_nodes)
+
+
+def _neighcom(node, status):
+    """Compute the communities in the neighborhood of node and the weights
+    of the links to each of them, in the order of their first appearance."""
+    start, end = status.indptr[node], status.indptr[node + 1]
+    # The communities of the neighbours are gathered in a single vectorized
+    # lookup; only the edges crossing communities are visited one by one
+    communities = status.node2com[status.indices[start:end]].tolist()
+    weights = status.weights[start:end].tolist()
+    if len(set(communities)) == 1:
+        return {communities[0]: sum(weights)}
+
+    neigh_communities = {}
+    for neighborcom, edge_weight in zip(communities, weights):
+        neigh_communities[neighborcom] = \
+            neigh_communities.get(neighborcom, 0) + edge_weight
+    return neigh_communities
+
+
+def _one_level(status, resolution, random_state, monitor=None):
+    """Compute one level of communities"""
+    node2com, gdegrees, loops = status.node2com, status.gdegrees, status.loops
+    degrees = status.degrees
+
+    modified = True
+    nb_pass_done = 0
+    cur_mod = status.modularity
+    new_mod = cur_mod
+
+    while modified and nb_pass_done != _PASS_MAX:
+        cur_mod = new_mod
+        modified = False
+        nb_pass_done += 1
+
+        for idx, node in enumerate(_node_order(len(node2com), random_state)):
+            if monitor is not None and idx % _BATCH_SIZE == 0:
+                monitor.check(idx, len(node2com))
+            com_node = node2com.item(node)
+            gdegree, loop = gdegrees.item(node), loops.item(node)
+            degc_totw = gdegree / (status.total_weight * 2.)
+            neigh_communities = _neighcom(node, status)
+            candidates = list(neigh_communities.items())
+            if random_state is not None:
+                candidates = [candidates[i] for i in
+                              random_state.permutation(len(candidates))]
+
+            # The node is only removed from its community if it moves; the
+            # gain of staying is evaluated as if it were removed
+            best_com = com_node
+            best_increase = 0
+            for com, dnc in candidates:
+                degree = degrees.item(com)
+                if com == com_node:
+                    degree -= gdegree
+                incr = resolution * dnc - degree * degc_totw
+                if incr > best_increase:
+                    best_increase = incr
+                    best_com = com
+
+            if best_com != com_node:
+                _remove(node, com_node, gdegree,
+                        neigh_communities.get(com_node, 0.) + loop, status)
+                _insert(node, best_com, gdegree,
+                        neigh_communities.get(best_com, 0.) + loop, status)
+                modified = True
+        new_mod = status.modularity
+        if monitor is not None:
+            monitor.end_pass()
+        if new_mod - cur_mod < _MIN:
+            break
+
+
+def _fast_local_moving(status, resolution, random_state, monitor=None):
+    """Move nodes between communities, using a queue that only revisits
+    the nodes whose neighbourhood changed"""
+    node2com, gdegrees, loops = status.node2com, status.gdegrees, status.loops
+    degrees, indptr, indices = status.degrees, status.indptr, status.indices
+    n_nodes = len(node2com)
+
+    sizes = np.bincount(node2com, minlength=n_nodes)
+    empty = np.flatnonzero(sizes == 0).tolist()
+    queue = deque(_node_order(n_nodes, random_state))
+    in_queue = np.ones(n_nodes, dtype=bool)
+
+    # Progress is reported as if a pass ended each time n_nodes were visited
+    visited = 0
+    while queue:
+        if monitor is not None and visited % _BATCH_SIZE == 0:
+            monitor.check(visited % n_nodes, n_nodes)
+        visited += 1
+        if visited % n_nodes == 0 and monitor is not None:
+            monitor.end_pass()
+        node = queue.popleft()
+        in_queue[node] = False
+
+        com_node = node2com.item(node)
+        gdegree, loop = gdegrees.item(node), loops.item(node)
+        degc_totw = gdegree / (status.total_weight * 2.)
+        neigh_communities = _neighcom(node, status)
+
+        best_com = com_node
+        best_increase = resolution * neigh_communities.get(com_node, 0.) - \
+            (degrees.item(com_node) - gdegree) * degc_totw
+        for com, dnc in neigh_communities.items():
+            incr = resolution * dnc - degrees.item(com) * degc_totw
+            if incr > best_increase:
+                best_increase = incr
+                best_com = com
+        # An empty community has no gain, which is better than staying
+        if best_increase < 0 and sizes[com_node] > 1:
+            best_com = empty.pop()
+
+        if best_com == com_node:
+            continue
+
+        _remove(node, com_node, gdegree,
+                neigh_communities.get(com_node, 0.) + loop, status)
+        _insert(node, best_com, gdegree,
+                neigh_communities.get(best_com, 0.) + loop, status)
+        sizes[com_node] -= 1
+        sizes[best_com] += 1
+        if sizes[com_node] == 0:
+            empty.append(com_node)
+
+        # Revisit the neighbours that are not in the new community
+        neighbors = indices[indptr[node]:indptr[node + 1]]
+        neighbors = neighbors[~in_queue[neighbors] &
+                              (node2com[neighbors] != best_com)]
+        in_queue[neighbors] = True
+        queue.extend(neighbors.tolist())
+
+
+def _refine(status, partition, resolution, random_state, theta,
+            monitor=None):
+    """Split every community into well connected subcommunities by merging
+    singletons within it
+
+    Returns the refined partition, where every subcommunity lies within a
+    single community of `partition`. Without `random_state`, the nodes are
+    visited in order and merged into the subcommunity with the highest gain.
+    """
+    indptr, indices, weights = status.indptr, status.indices, status.weights
+    gdegrees = status.gdegrees
+    n_nodes = len(partition)
+    two_m = status.total_weight * 2.
+
+    # The weight of links from each node to the rest of its community
+    rows = np.repeat(np.arange(n_nodes), np.diff(indptr))
+    same = partition[rows] == partition[indices]
+    node_external = np.bincount(rows[same], weights=weights[same],
+                                minlength=n_nodes)
+    com_degrees = np.bincount(partition, weights=gdegrees)
+
+    refined = np.arange(n_nodes)
+    ref_sizes = np.ones(n_nodes, dtype=int)
+    ref_degrees = gdegrees.copy()
+    ref_external = node_external.copy()
+
+    for idx, node in enumerate(_node_order(n_nodes, random_state)):
+        if monitor is not None and idx % _BATCH_SIZE == 0:
+            monitor.check_cancelled()
+        if ref_sizes[node] > 1:
+            continue
+        com, gdegree = partition.item(node), gdegrees.item(node)
+        com_degree = com_degrees.item(com)
+        # Only merge nodes that are well connected to their community
+        if resolution * node_external.item(node) < \
+                gdegree * (com_degree - gdegree) / two_m:
+            continue
+
+        start, end = indptr[node], indptr[node + 1]
+        neighbors = indices[start:end]
+        mask = partition[neighbors] == com
+        neigh_subcommunities = {}
+        for subcom, edge_weight in zip(refined[neighbors[mask]].tolist(),
+                                       weights[start:end][mask].tolist()):
+            neigh_subcommunities[subcom] = \
+                neigh_subcommunities.get(subcom, 0) + edge_weight
+
+        candidates, gains = [], []
+        for subcom, dnc in neigh_subcommunities.items():
+            subcom_degree = ref_degrees.item(subcom)
+            # ... and into subcommunities well connected to the community
+            if resolution * ref_external.item(subcom) < \
+                    subcom_degree * (com_degree - subcom_degree) / two_m:
+                continue
+            gain = resolution * dnc - subcom_degree * gdegree / two_m
+            if gain >= 0:
+                candidates.append(subcom)
+                gains.append(gain)
+        if not candidates:
+            continue
+
+        gains = np.array(gains)
+        if theta > 0 and random_state is not None:
+            probabilities = np.exp((gains - gains.max()) / theta)
+            chosen = random_state.choice(
+                len(candidates), p=probabilities / probabilities.sum())
+        else:
+            chosen = np.argmax(gains)
+        subcom = candidates[chosen]
+
+        refined[node] = subcom
+        ref_sizes[node] -= 1
+        ref_sizes[subcom] += 1
+        ref_degrees[subcom] += gdegree
+        ref_external[subcom] += node_external.item(node) - \
+            2 * neigh_subcommunities[subcom]
+
+    return refined
+
+
+def _community_modularity(com, status):
+    """The contribution of a single community to the modularity"""
+    links = status.total_weight
+    return (status.internals.item(com) / links -
+            (status.degrees.item(com) / (2. * links)) ** 2)
+
+
+def _remove(node, com, degree, weight, status):
+    """Remove node from community com and update the modularity"""
+    status.modularity -= _community_modularity(com, status)
+    status.degrees[com] -= degree
+    status.internals[com] -= weight
+    status.modularity += _community_modularity(com, status)
+    status.node2com[node] = -1
+
+
+def _insert(node, com, degree, weight, status):
+    """Insert node into community com and update the modularity"""
+    status.node2com[node] = com
+    status.modularity -= _community_modularity(com, status)
+    status.degrees[com] += degree
+    status.internals[com] += weight
+    status.modularity += _community_modularity(com, status)
+
+
+def _modularity(status):
+    """Compute the modularity of the partition of the graph from scratch
+    using the precomputed status"""
+    links = float(status.total_weight)
+    if links <= 0:
+        return 0.
+    present = np.bincount(status.node2com, minlength=len(status.degrees)) > 0
+    in_degree = status.internals[present]
+    degree = status.degrees[present]
+    return float(np.sum(in_degree / links - (degree / (2. * links)) ** 2))
@@ -0,0 +1,358 @@
+"""Exact and approximate k nearest neighbour search.
+
+Every backend returns the distances and indices of the `k` nearest
+neighbours of all points, sorted by distance, in the format of
+:meth:`sklearn.neighbors.NearestNeighbors.kneighbors`; as there, the points
+are their own neighbours.
+
+Cosine and correlation distances are not computed directly. The points are
+normalized to unit length (after centring them for correlation) once, and
+searched in Euclidean space, where the distances are monotonic with the
+cosine and correlation distances, so that fast search structures can be
+used.
+
+The approximate backend builds a forest of random projection trees. The
+points that share a leaf of any tree are candidate neighbours, and the
+candidates are then improved by NN-descent, which looks for closer points
+among the neighbours of neighbours. More trees give a higher recall.
+
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.neighbors import NearestNeighbors
+from sklearn.preprocessing import normalize
+from sklearn.utils import check_random_state
+
+# Data sets smaller than this are always searched exhaustively
+_MIN_APPROXIMATE_SIZE = 5000
+_DEFAULT_TREES = 10
+_DEFAULT_LEAF_SIZE = 30
+# The number of NN-descent iterations after the forest search
+_DESCENT_ITERATIONS = 1
+# The number of nearest neighbours whose neighbours are NN-descent candidates
+_DESCENT_CANDIDATES = 15
+# The default approximate number of bytes of distance computations held in
+# memory at once
+_MEMORY_BUDGET = 1 << 28
+
+
+def nearest_neighbors(x, k, metric='l2', backend='exact', n_trees=None,
+                      random_state=None, progress_callback=None, n_jobs=None,
+                      memory_budget=None):
+    """Find the k nearest neighbours of every point
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The points, one per row
+    k : int
+        The number of neighbours, including the point itself
+    metric : str
+        A distance metric supported by sklearn; approximate search supports
+        'l2', 'l1', 'cosine' and 'correlation'
+    backend : str
+        One of :obj:`BACKENDS`, 'exact' or 'rp_forest'
+    n_trees : Optional[int]
+        The number of random projection trees; more trees increase the recall
+        of approximate search
+    random_state : Optional[Union[int, np.random.RandomState]]
+    progress_callback : Callable[[float], None]
+    n_jobs : Optional[int]
+        The number of threads of exact search, all processors if None
+    memory_budget : Optional[int]
+        The approximate number of bytes of distances computed at once; the
+        points are queried in blocks of rows that fit into it
+
+    Returns
+    -------
+    distances : np.ndarray
+    indices : np.ndarray
+        Arrays of shape (n_points, k), sorted by distance
+
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown nearest neighbour backend '{}'".format(
+            backend))
+    # Exhaustive search is fast enough and precise on small data
+    if backend != 'exact' and len(x) < _MIN_APPROXIMATE_SIZE:
+        backend = 'exact'
+    x, search_metric = _normalize(x, metric)
+    distances, indices = BACKENDS[backend](
+        x, k, metric=search_metric, n_trees=n_trees,
+        random_state=random_state, progress_callback=progress_callback,
+        n_jobs=n_jobs, memory_budget=memory_budget or _MEMORY_BUDGET)
+    if search_metric != metric:
+        distances = _from_euclidean(distances)
+    return distances, indices
+
+
+def pair_distances(x, rows, columns, metric='l2'):
+    """Compute the distances between pairs of points
+
+    Parameters
+    ----------
+    x : Union[np.ndarray, sp.spmatrix]
+        The points, one per row
+    rows, columns : np.ndarray
+        The indices of the first and the second point of each pair
+    metric : str
+        'l2', 'l1', 'cosine' or 'correlation'
+
+    Returns
+    -------
+    np.ndarray
+
+    """
+    x, search_metric = _normalize(x, metric)
+    if search_metric not in _DISTANCES:
+        raise ValueError("Unsupported metric '{}'".format(metric))
+    distances = _DISTANCES[search_metric](x[rows], x[columns])
+    if search_metric != metric:
+        distances = _from_euclidean(distances)
+    return distances
+
+
+def estimate_recall(x, indices, metric='l2', sample_size=200,
+                    random_state=None):
+    """Estimate the fraction of true nearest neighbours among the given ones
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The points, one per row
+    indices : np.ndarray
+        The neighbours of every point, as returned by `nearest_neighbors`
+    metric : str
+    sample_size : int
+        The number of points whose exact neighbours are computed
+    random_state : Optional[Union[int, np.random.RandomState]]
+
+    Returns
+    -------
+    float
+
+    """
+    n_points, k = indices.shape
+    x, metric = _normalize(x, metric)
+    random_state = check_random_state(random_state)
+    sample = random_state.choice(
+        n_points, min(sample_size, n_points), replace=False)
+    _, exact = NearestNeighbors(n_neighbors=k, metric=_sklearn_metric(metric)) \
+        .fit(x).kneighbors(x[sample])
+    found = [len(np.intersect1d(approximate, true))
+             for approximate, true in zip(indices[sample], exact)]
+    return np.sum(found) / exact.size
+
+
+def _exact_neighbors(x, k, metric='l2', progress_callback=None, n_jobs=None,
+                     memory_budget=_MEMORY_BUDGET, **_):
+    knn = NearestNeighbors(n_neighbors=k, metric=_sklearn_metric(metric)) \
+        .fit(x)
+
+    # Blocks are queried concurrently, each computing at most the distances
+    # to all points, so together they stay within the budget
+    n_points = len(x)
+    n_jobs = n_jobs or os.cpu_count() or 1
+    block_size = max(1, memory_budget // (8 * n_points * n_jobs))
+    starts = range(0, n_points, block_size)
+
+    distances = np.empty((n_points, k))
+    indices = np.empty((n_points, k), dtype=int)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        blocks = executor.map(
+            lambda start: knn.kneighbors(x[start:start + block_size]), starts)
+        for done, (start, block) in enumerate(zip(starts, blocks)):
+            if progress_callback:
+                progress_callback(done / len(starts))
+            distances[start:start + block_size] = block[0]
+            indices[start:start + block_size] = block[1]
+    return distances, indices
+
+
+def _rp_forest_neighbors(x, k, metric='l2', n_trees=None, random_state=None,
+                         progress_callback=None, memory_budget=_MEMORY_BUDGET,
+                         **_):
+    if metric not in _DISTANCES:
+        raise ValueError("Approximate search does not support the '{}' "
+                         "metric".format(metric))
+    x = x.toarray() if sp.issparse(x) else np.asarray(x, dtype=float)
+    n_trees = n_trees or _DEFAULT_TREES
+    random_state = check_random_state(random_state)
+    # Splits are balanced, so leaves have between leaf_size / 2 and
+    # leaf_size points and every point finds k candidates in its leaf
+    leaf_size = max(_DEFAULT_LEAF_SIZE, 2 * k)
+
+    n_steps = n_trees + _DESCENT_ITERATIONS
+    distances = np.full((len(x), k), np.inf)
+    indices = np.full((len(x), k), -1)
+    for tree in range(n_trees):
+        if progress_callback:
+            progress_callback(tree / n_steps)
+        leaves = _rp_tree_leaves(x, leaf_size, random_state)
+        distances, indices = _merge_candidates(
+            distances, indices,
+            *_leaf_candidates(x, leaves, metric, memory_budget))
+
+    for iteration in range(_DESCENT_ITERATIONS):
+        if progress_callback:
+            progress_callback((n_trees + iteration) / n_steps)
+        distances, indices = _descend(x, distances, indices, metric,
+                                      memory_budget)
+
+    order = np.argsort(distances, axis=1, kind='stable')
+    return (np.take_along_axis(distances, order, axis=1),
+            np.take_along_axis(indices, order, axis=1))
+
+
+def _normalize(x, metric):
+    """Map the points for cosine and correlation distances to the unit
+    sphere, and return them with the metric to search them with. Sparse
+    points stay sparse, unless centring them for correlation fills them."""
+    if metric not in ('cosine', 'correlation'):
+        return x, metric
+    if metric == 'correlation':
+        x = x.toarray() if sp.issparse(x) else np.asarray(x, dtype=float)
+        x = x - x.mean(axis=1, keepdims=True)
+    # Points at the origin stay there
+    return normalize(x), 'l2'
+
+
+def _sklearn_metric(metric):
+    """Return the name under which sklearn computes the metric fastest;
+    it only uses its optimized Euclidean distances for 'euclidean'."""
+    return {'l2': 'euclidean', 'l1': 'manhattan'}.get(metric, metric)
+
+
+def _from_euclidean(distances):
+    """Convert Euclidean distances between unit vectors to cosine
+    distances, 1 - cos(a, b) = |a - b|^2 / 2"""
+    return distances ** 2 / 2
+
+
+BACKENDS = {
+    'exact': _exact_neighbors,
+    'rp_forest': _rp_forest_neighbors,
+}
+
+
+def _euclidean(x, y):
+    if sp.issparse(x):
+        diff = x - y
+        return np.sqrt(np.asarray(diff.multiply(diff).sum(axis=1)).ravel())
+    diff = x - y
+    return np.sqrt(np.einsum('...i,...i->...', diff, diff))
+
+
+def _manhattan(x, y):
+    if sp.issparse(x):
+        return np.asarray(abs(x - y).sum(axis=1)).ravel()
+    return np.sum(np.abs(x - y), axis=-1)
+
+
+_DISTANCES = {'l2': _euclidean, 'euclidean': _euclidean,
+              'l1': _manhattan, 'manhattan': _manhattan}
+
+
+def _rp_tree_leaves(x, leaf_size, random_state):
+    """Split the points by random hyperplanes until at most `leaf_size`
+    points remain on each side, and return the indices of the leaves."""
+    leaves, stack = [], [np.arange(len(x))]
+    while stack:
+        points = stack.pop()
+        if len(points) <= leaf_size:
+            leaves.append(points)
+            continue
+        # The hyperplane is orthogonal to the line between two random points;
+        # splitting at the median projection keeps the tree balanced
+        first, second = random_state.choice(len(points), 2, replace=False)
+        projection = x[points].dot(x[points[first]] - x[points[second]])
+        half = len(points) // 2
+        order = np.argpartition(projection, half)
+        stack.extend((points[order[:half]], points[order[half:]]))
+    return leaves
+
+
+def _leaf_candidates(x, leaves, metric, memory_budget):
+    """Return the distances and indices of the points in the leaf of each
+    point, padded with infinite distances to the size of the largest leaf."""
+    sizes = np.array([len(leaf) for leaf in leaves])
+    leaf_size = sizes.max()
+    # Leaves are stacked into rows padded with -1
+    members = np.arange(leaf_size) < sizes[:, None]
+    padded = np.full(members.shape, -1)
+    padded[members] = np.concatenate(leaves)
+
+    leaf_distances = np.empty(padded.shape + (leaf_size,))
+    block_size = max(1, memory_budget // (8 * leaf_size ** 2 * x.shape[1]))
+    for start in range(0, len(leaves), block_size):
+        points = padded[start:start + block_size]
+        leaf_distances[start:start + block_size] = _batch_distances(
+            x, points, points, metric)
+    leaf_distances[~np.broadcast_to(members[:, None], leaf_distances.shape)] \
+        = np.inf
+
+    # The rows of the members, in the order of the points
+    order = np.argsort(padded[members])
+    candidates = np.broadcast_to(padded[:, None], leaf_distances.shape)
+    return leaf_distances[members][order], candidates[members][order]
+
+
+def _batch_distances(x, rows, columns, metric):
+    """Compute the distances between the points indexed by each row of
+    `rows` and those indexed by the same row of `columns`, in an array of
+    shape (len(rows), rows.shape[1], columns.shape[1])."""
+    if metric not in ('l2', 'euclidean'):
+        return _DISTANCES[metric](x[rows][:, :, None], x[columns][:, None])
+    # Euclidean distances are computed with matrix products, like in sklearn
+    x_rows, x_columns = x[rows], x[columns]
+    squared = np.einsum('ijk,ijk->ij', x_rows, x_rows)[:, :, None] \
+        + np.einsum('ijk,ijk->ij', x_columns, x_columns)[:, None] \
+        - 2 * np.matmul(x_rows, x_columns.transpose(0, 2, 1))
+    # The rounding errors do not make points closer to others than to
+    # themselves
+    squared[rows[:, :, None] == columns[:, None]] = 0
+    return np.sqrt(np.maximum(squared, 0, out=squared))
+
+
+def _merge_candidates(distances, indices, new_distances, new_indices):
+    """Keep the nearest distinct neighbours among the current ones and the
+    candidates, row by row."""
+    k = distances.shape[1]
+    distances = np.hstack((distances, new_distances))
+    indices = np.hstack((indices, new_indices))
+
+    # Candidates found again are dropped by setting their distance to inf
+    order = np.argsort(indices, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1)
+    distances = np.take_along_axis(distances, order, axis=1)
+    duplicate = np.zeros(indices.shape, dtype=bool)
+    duplicate[:, 1:] = indices[:, 1:] == indices[:, :-1]
+    distances[duplicate] = np.inf
+
+    nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return (np.take_along_axis(distances, nearest, axis=1),
+            np.take_along_axis(indices, nearest, axis=1))
+
+
+def _descend(x, distances, indices, metric, memory_budget):
+    """Improve the neighbours with one iteration of NN-descent, which takes
+    the nearest neighbours of the nearest neighbours as candidates."""
+    n_points, k = indices.shape
+    n_near = min(k, _DESCENT_CANDIDATES)
+    block_size = max(1, memory_budget // (8 * n_near ** 2 * x.shape[1]))
+    new_distances, new_indices = distances.copy(), indices.copy()
+    for start in range(0, n_points, block_size):
+        stop = min(start + block_size, n_points)
+        # Candidates that are already neighbours or repeat are dropped when
+        # merging
+        near = indices[start:stop, :n_near]
+        candidates = indices[near, :n_near].reshape(stop - start, -1)
+        candidate_distances = _batch_distances(
+            x, np.arange(start, stop)[:, None], candidates, metric)[:, 0]
+        new_distances[start:stop], new_indices[start:stop] = \
+            _merge_candidates(distances[start:stop], indices[start:stop],
+                              candidate_distances, candidates)
+    return new_distances, new_indices
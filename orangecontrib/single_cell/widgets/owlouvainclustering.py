@@ -1,17 +1,20 @@
+import os
+import threading
 from collections import deque
-from concurrent.futures import Future
+from concurrent.futures import Future, CancelledError
 from enum import Enum
+from functools import partial
 from types import SimpleNamespace as namespace
 from typing import Optional
 
 import networkx as nx
 import numpy as np
+import scipy.sparse as sp
 from AnyQt.QtCore import Qt, pyqtSignal as Signal, QObject
 from AnyQt.QtWidgets import QSlider, QCheckBox, QWidget
-from sklearn.neighbors import NearestNeighbors
 
-from Orange.data import Table, DiscreteVariable
-from Orange.projection import PCA
+from Orange.data import Table, DiscreteVariable, ContinuousVariable
+from Orange.misc.environ import cache_dir
 from Orange.widgets import widget, gui
 from Orange.widgets.settings import DomainContextHandler, ContextSetting, \
     Setting
@@ -20,31 +23,57 @@ from Orange.widgets.utils.annotated_data import get_next_name, add_columns, \
 from Orange.widgets.utils.concurrent import ThreadExecutor
 from Orange.widgets.utils.signals import Input, Output
 from Orange.widgets.widget import Msg
-from orangecontrib.single_cell.widgets.louvain import best_partition
+from orangecontrib.single_cell.widgets.cache import DiskCache, cache_key, \
+    same_content
+from orangecontrib.single_cell.widgets.louvain_csr import \
+    adjacency_to_graph, best_partition, ensemble_partition, \
+    generate_dendrogram, partition_at_level, run_in_process
+from orangecontrib.single_cell.widgets.nearest_neighbors import \
+    estimate_recall, nearest_neighbors, pair_distances
+from orangecontrib.single_cell.widgets.pca import pca
 import Orange.statistics.util as ut
 
 try:
-    from orangecontrib.network.network import Graph
-except:
-    Graph = None
+    # Recent versions of the network add-on build networks from sparse
+    # matrices, older ones wrap networkx graphs
+    from orangecontrib.network.network import Network, UndirectedEdges
+    Graph = Network
+except ImportError:
+    Network = UndirectedEdges = None
+    try:
+        from orangecontrib.network.network import Graph
+    except:
+        Graph = None
 
 
 _MAX_PCA_COMPONENTS = 50
 _DEFAULT_PCA_COMPONENTS = 25
 _MAX_K_NEIGBOURS = 200
 _DEFAULT_K_NEIGHBOURS = 30
-
-
-METRICS = [('Euclidean', 'l2'), ('Manhattan', 'l1')]
-
-
-def jaccard(x, y):
-    # type: (set, set) -> float
-    """Compute the Jaccard similarity between two sets."""
-    return len(x & y) / len(x | y)
-
-
-def table_to_graph(data, k_neighbours, metric, progress_callback=None):
+# Neighbours are searched up to this k, so that smaller k reuse them
+_DEFAULT_MAX_K_NEIGHBOURS = 50
+_MAX_ENSEMBLE_RUNS = 100
+_DEFAULT_ENSEMBLE_RUNS = 10
+_MAX_ANN_TREES = 50
+_DEFAULT_ANN_TREES = 10
+# Links with a smaller Jaccard similarity are removed when pruning
+_DEFAULT_PRUNE_THRESHOLD = 1 / 15
+# The number of cells whose exact neighbours are used to measure the recall
+_RECALL_SAMPLE_SIZE = 200
+
+graph_cache = DiskCache(os.path.join(cache_dir(), 'louvain'), size_limit=5e8)
+# The number of kNN links whose shared neighbours are counted at once
+_GRAPH_BLOCK_SIZE = 100000
+
+
+METRICS = [('Euclidean', 'l2'), ('Manhattan', 'l1'), ('Cosine', 'cosine'),
+           ('Correlation', 'correlation')]
+METHODS = [('Louvain', 'louvain'), ('Leiden', 'leiden')]
+ANN_BACKENDS = [('Exact', 'exact'), ('Approximate', 'rp_forest')]
+
+
+def table_to_graph(data, k_neighbours, metric, progress_callback=None,
+                   ann_backend='exact', ann_trees=None, prune=0.):
     """Convert tabular data to a graph using a nearest neighbours approach with
     the Jaccard similarity as the edge weights.
 
@@ -55,31 +84,107 @@ def table_to_graph(data, k_neighbours, metric, progress_callback=None):
     metric : str
         A distance metric supported by sklearn.
     progress_callback : Callable[[float], None]
+    ann_backend : str
+        The nearest neighbour search, 'exact' or approximate 'rp_forest'.
+    ann_trees : Optional[int]
+        The number of trees of approximate search.
+    prune : float
+        Links with a smaller Jaccard similarity are removed.
 
     Returns
     -------
-    nx.Graph
+    sp.csr_matrix
+        The symmetric adjacency matrix of the graph, with self-loops on the
+        diagonal as in networkx
 
     """
-    # We do k + 1 because each point is closest to itself, which is not useful
-    knn = NearestNeighbors(n_neighbors=k_neighbours, metric=metric).fit(data.X)
-    nearest_neighbours = knn.kneighbors(data.X, return_distance=False)
-    # Convert to list of sets so jaccard can be computed efficiently
-    nearest_neighbours = list(map(set, nearest_neighbours))
-    num_nodes = len(nearest_neighbours)
-
-    # Create an empty graph and add all the data ids as nodes for easy mapping
-    graph = nx.Graph()
-    graph.add_nodes_from(range(len(data)))
-
-    for idx, node in enumerate(graph.nodes):
+    if progress_callback is None:
+        progress_callback = lambda _: None
+
+    _, nearest_neighbours = nearest_neighbors(
+        data.X, k_neighbours, metric=metric, backend=ann_backend,
+        n_trees=ann_trees, random_state=0,
+        progress_callback=lambda p: progress_callback(p / 2),
+    )
+    graph = knn_to_graph(
+        nearest_neighbours,
+        progress_callback=lambda p: progress_callback(0.5 + p / 2),
+    )
+    return prune_links(graph, prune)
+
+
+def knn_to_graph(nearest_neighbours, progress_callback=None):
+    """Build the graph of nearest neighbours with the Jaccard similarity as
+    the edge weights.
+
+    Two points are linked if either is among the nearest neighbours of the
+    other. The link is weighted by the Jaccard similarity of their
+    neighbourhoods, which is obtained from the number of shared neighbours in
+    the product of the kNN indicator matrix with its transpose.
+
+    Parameters
+    ----------
+    nearest_neighbours : np.ndarray
+        The indices of the k nearest neighbours of every point, including the
+        point itself
+    progress_callback : Callable[[float], None]
+
+    Returns
+    -------
+    sp.csr_matrix
+
+    """
+    num_nodes, k_neighbours = nearest_neighbours.shape
+
+    # The kNN indicator matrix, K[i, j] = 1 if j is a neighbour of i
+    knn_matrix = sp.csr_matrix(
+        (np.ones(nearest_neighbours.size),
+         nearest_neighbours.ravel(),
+         np.arange(0, nearest_neighbours.size + 1, k_neighbours)),
+        shape=(num_nodes, num_nodes))
+    edges = sp.csr_matrix(knn_matrix + knn_matrix.T)
+    edges.data[:] = 1
+    edges.sort_indices()
+
+    # Count the shared neighbours of linked points in blocks of rows, so that
+    # the full product K K^T is never materialized
+    shared = np.empty(edges.nnz)
+    block_size = max(1, _GRAPH_BLOCK_SIZE // k_neighbours)
+    for start in range(0, num_nodes, block_size):
         if progress_callback:
-            progress_callback(idx / num_nodes)
+            progress_callback(start / num_nodes)
+        end = min(start + block_size, num_nodes)
+        block = edges[start:end]
+        counts = block.multiply(knn_matrix[start:end].dot(knn_matrix.T))
+        # Adding the links keeps those without shared neighbours, so the
+        # entries line up with the links of the block
+        counts = sp.csr_matrix(counts + block)
+        counts.sort_indices()
+        shared[edges.indptr[start]:edges.indptr[end]] = counts.data - 1
+
+    # All neighbourhoods have k points, so the union has 2k - shared points
+    edges.data = shared / (2 * k_neighbours - shared)
+    return edges
+
+
+def prune_links(graph, threshold):
+    """Remove the links with a weight below the threshold.
+
+    Parameters
+    ----------
+    graph : sp.csr_matrix
+    threshold : float
 
-        for neighbour in nearest_neighbours[node]:
-            graph.add_edge(node, neighbour, weight=jaccard(
-                nearest_neighbours[node], nearest_neighbours[neighbour]))
+    Returns
+    -------
+    sp.csr_matrix
 
+    """
+    if not threshold:
+        return graph
+    graph = graph.copy()
+    graph.data[graph.data < threshold] = 0
+    graph.eliminate_zeros()
     return graph
 
 
@@ -94,10 +199,16 @@ class TaskQueue(QObject):
         super().__init__(parent=parent)
         self.__tasks = deque()
         self.__progress = 0
+        self.__cancel_token = threading.Event()
 
     def push(self, task):
         self.__tasks.append(task)
 
+    def cancel(self):
+        """Stop the running task at its next cancellation check and do not
+        run the remaining ones."""
+        self.__cancel_token.set()
+
     def __set_progress(self, progress):
         # Only emit progress signal when the progress has changed sufficiently
         if int(progress * 100) > int(self.__progress * 100):
@@ -119,13 +230,22 @@ class TaskQueue(QObject):
                 relative_progress = task_percentage * percentage
                 self.__set_progress(current_progress + relative_progress)
 
+            kwargs = {}
+            if getattr(task_spec, 'progress_callback', False):
+                kwargs['progress_callback'] = __task_progress
+            if getattr(task_spec, 'cancel_token', False):
+                kwargs['cancel_token'] = self.__cancel_token
+
             try:
-                if getattr(task_spec, 'progress_callback', False):
-                    task_spec.task(progress_callback=__task_progress)
-                else:
-                    task_spec.task()
+                if self.__cancel_token.is_set():
+                    raise CancelledError()
+                task_spec.task(**kwargs)
                 self.__set_progress((idx + 1) / num_tasks)
 
+            except CancelledError:
+                # Cancelled queues complete silently; the widget finalizes
+                # them when it cancels them
+                return
             except Exception as e:
                 self.on_exception.emit(e)
                 break
@@ -159,6 +279,16 @@ class OWLouvainClustering(widget.OWWidget):
     metric_idx = ContextSetting(0)
     k_neighbours = ContextSetting(_DEFAULT_K_NEIGHBOURS)
     resolution = ContextSetting(1.)
+    method_idx = ContextSetting(0)
+    use_ensemble = ContextSetting(False)
+    ensemble_runs = ContextSetting(_DEFAULT_ENSEMBLE_RUNS)
+    max_k_neighbours = Setting(_DEFAULT_MAX_K_NEIGHBOURS)
+    ann_backend_idx = ContextSetting(0)
+    ann_trees = ContextSetting(_DEFAULT_ANN_TREES)
+    use_pruning = ContextSetting(False)
+    prune_threshold = ContextSetting(_DEFAULT_PRUNE_THRESHOLD)
+    warm_start = Setting(True)
+    output_levels = Setting(False)
     auto_commit = Setting(True)
 
     class Error(widget.OWWidget.Error):
@@ -169,6 +299,13 @@ class OWLouvainClustering(widget.OWWidget):
         empty_dataset = Msg('No features in data')
         general_error = Msg('Error occured during clustering\n{}')
 
+    class Information(widget.OWWidget.Information):
+        approximate_recall = Msg(
+            'Approximate search found {:.0%} of the nearest neighbours '
+            '(measured on {} cells)'
+        )
+        pruned_links = Msg('Pruning removed {} of {} links')
+
     class State(Enum):
         Pending, Running = range(2)
 
@@ -176,11 +313,35 @@ class OWLouvainClustering(widget.OWWidget):
         super().__init__()
 
         self.data = None  # type: Optional[Table]
-        self.graph = None  # type: Optional[nx.Graph]
+        self.graph = None  # type: Optional[sp.csr_matrix]
+        # The distances and indices of the nearest neighbours of all cells,
+        # sorted by distance and possibly for more than `k_neighbours`
+        self.neighbours = None  # type: Optional[tuple]
+        # The recall of approximate neighbour search on a sample of cells
+        self.recall = None  # type: Optional[float]
+        # The numbers of removed and all links of the graph before pruning
+        self.pruned_links = None  # type: Optional[tuple]
+        # The links of the graph, each once, and the distances between the
+        # linked cells, for the network output
+        self.link_distances = None  # type: Optional[tuple]
         self.partition = None  # type: Optional[np.array]
+        # All the levels of the hierarchy and the level of `partition`
+        self.dendrogram = None  # type: Optional[list]
+        self.level = None  # type: Optional[int]
+        # Per-cell stability of the consensus partition
+        self.stability = None  # type: Optional[np.array]
+        # Dendrograms and their stability on the current graph, keyed by
+        # method, resolution and the number of consensus runs
+        self.partition_cache = {}  # type: dict
+        # The selected item of the level combo
+        self.dendrogram_level = 0
+        # The row ids and labels of the last computed partition, used to
+        # seed the next one
+        self.previous_partition = None  # type: Optional[tuple]
 
         self.__executor = ThreadExecutor(parent=self)
         self.__future = None  # type: Optional[Future]
+        self.__queue = None  # type: Optional[TaskQueue]
         self.__state = self.State.Pending
 
         pca_box = gui.vBox(self.controlArea, 'PCA Preprocessing')
@@ -205,11 +366,62 @@ class OWLouvainClustering(widget.OWWidget):
             label='k neighbours', controlWidth=80, alignment=Qt.AlignRight,
             callback=self._update_k_neighbors,
         )  # type: gui.SpinBoxWFocusOut
+        self.max_k_neighbours_spin = gui.spin(
+            graph_box, self, 'max_k_neighbours', minv=1,
+            maxv=_MAX_K_NEIGBOURS, label='Precompute neighbours up to k',
+            controlWidth=80, alignment=Qt.AlignRight,
+        )  # type: gui.SpinBoxWFocusOut
+        self.ann_backend_combo = gui.comboBox(
+            graph_box, self, 'ann_backend_idx', label='Neighbour search',
+            items=[b[0] for b in ANN_BACKENDS],
+            callback=self._update_ann_backend, orientation=Qt.Horizontal,
+        )  # type: gui.OrangeComboBox
+        self.ann_trees_spin = gui.spin(
+            graph_box, self, 'ann_trees', minv=1, maxv=_MAX_ANN_TREES,
+            label='Search trees', controlWidth=80, alignment=Qt.AlignRight,
+            callback=self._update_ann_trees,
+        )  # type: gui.SpinBoxWFocusOut
+        self.ann_trees_spin.setEnabled(self.ann_backend_idx != 0)
+        self.prune_threshold_spin = gui.spin(
+            graph_box, self, 'prune_threshold', 0, 1, 1e-3, spinType=float,
+            label='Prune links below', controlWidth=80,
+            alignment=Qt.AlignRight, checked='use_pruning',
+            checkCallback=self._update_pruning,
+            callback=self._update_pruning,
+        )  # type: gui.SpinBoxWFocusOut
         self.cls_epsilon_spin = gui.spin(
             graph_box, self, 'resolution', 0, 5., 1e-2, spinType=float,
             label='Resolution', controlWidth=80, alignment=Qt.AlignRight,
             callback=self._update_resolution,
         )  # type: gui.SpinBoxWFocusOut
+        self.method_combo = gui.comboBox(
+            graph_box, self, 'method_idx', label='Method',
+            items=[m[0] for m in METHODS], callback=self._update_method,
+            orientation=Qt.Horizontal,
+        )  # type: gui.OrangeComboBox
+        self.ensemble_runs_spin = gui.spin(
+            graph_box, self, 'ensemble_runs', minv=2,
+            maxv=_MAX_ENSEMBLE_RUNS, label='Consensus of runs',
+            controlWidth=80, alignment=Qt.AlignRight,
+            checked='use_ensemble', checkCallback=self._update_ensemble,
+            callback=self._update_ensemble,
+        )  # type: gui.SpinBoxWFocusOut
+        self.warm_start_cbx = gui.checkBox(
+            graph_box, self, 'warm_start',
+            label='Start from previous clustering',
+        )  # type: QCheckBox
+        self._enable_warm_start()
+
+        levels_box = gui.vBox(self.controlArea, 'Hierarchy')
+        self.level_combo = gui.comboBox(
+            levels_box, self, 'dendrogram_level', label='Level',
+            callback=self._update_level, orientation=Qt.Horizontal,
+        )  # type: gui.OrangeComboBox
+        self.output_levels_cbx = gui.checkBox(
+            levels_box, self, 'output_levels',
+            label='Output clusters at all levels',
+            callback=self._update_output_levels,
+        )  # type: QCheckBox
 
         self.apply_button = gui.auto_commit(
             self.controlArea, self, 'auto_commit', 'Apply', box=None,
@@ -217,7 +429,7 @@ class OWLouvainClustering(widget.OWWidget):
         )  # type: QWidget
 
     def _update_apply_pca(self):
-        self._invalidate_graph()
+        self._invalidate_neighbours()
         self.commit()
 
     def _update_pca_components(self):
@@ -225,10 +437,28 @@ class OWLouvainClustering(widget.OWWidget):
         self.commit()
 
     def _update_metric(self):
-        self._invalidate_graph()
+        self._invalidate_neighbours()
         self.commit()
 
     def _update_k_neighbors(self):
+        # Smaller k take the first columns of the neighbours already found
+        if self.neighbours is not None \
+                and self.neighbours[1].shape[1] < self.k_neighbours:
+            self._invalidate_neighbours()
+        else:
+            self._invalidate_graph()
+        self.commit()
+
+    def _update_ann_backend(self):
+        self.ann_trees_spin.setEnabled(self.ann_backend_idx != 0)
+        self._invalidate_neighbours()
+        self.commit()
+
+    def _update_ann_trees(self):
+        self._invalidate_neighbours()
+        self.commit()
+
+    def _update_pruning(self):
         self._invalidate_graph()
         self.commit()
 
@@ -236,33 +466,212 @@ class OWLouvainClustering(widget.OWWidget):
         self._invalidate_partition()
         self.commit()
 
-    def _compute_pca_projection(self):
+    def _update_method(self):
+        self._enable_warm_start()
+        self._invalidate_partition()
+        self.commit()
+
+    def _update_ensemble(self):
+        self._enable_warm_start()
+        self._invalidate_partition()
+        self.commit()
+
+    def _enable_warm_start(self):
+        # Seeding Louvain with the final labels would collapse the levels of
+        # its dendrogram, so only a single Leiden run starts from them
+        self.warm_start_cbx.setEnabled(
+            METHODS[self.method_idx][1] == 'leiden' and not self.use_ensemble)
+
+    def _update_level(self):
+        if self.dendrogram is not None:
+            self._set_level(self.dendrogram_level)
+            self.commit()
+
+    def _update_output_levels(self):
+        self.commit()
+
+    def _set_dendrogram(self, dendrogram, stability):
+        self.dendrogram, self.stability = dendrogram, stability
+        self._set_level(len(dendrogram) - 1)
+
+    def _set_level(self, level):
+        self.level = level
+        self.partition = partition_at_level(self.dendrogram, level)
+
+    def _update_level_combo(self):
+        self.level_combo.clear()
+        if self.dendrogram is not None:
+            self.level_combo.addItems([
+                '{} ({} clusters)'.format(
+                    level + 1, len(np.unique(partition_at_level(
+                        self.dendrogram, level))))
+                for level in range(len(self.dendrogram))
+            ])
+            self.dendrogram_level = self.level
+
+    @staticmethod
+    def _check_cancelled(cancel_token):
+        """Stop a task before it stores results computed for parameters
+        that were changed in the meantime."""
+        if cancel_token is not None and cancel_token.is_set():
+            raise CancelledError()
+
+    def _compute_pca_projection(self, cancel_token=None):
         if self.pca_projection is None and self.apply_pca:
             self.setStatusMessage('Computing PCA...')
 
-            pca = PCA(n_components=self.pca_components, random_state=0)
-            model = pca(self.data)
-            self.pca_projection = model(self.data)
+            model = pca(self.data, self.pca_components, random_state=0)
+            projection = model(self.data)
+            self._check_cancelled(cancel_token)
+            self.pca_projection = projection
 
-    def _compute_graph(self, progress_callback=None):
+    def _compute_graph(self, progress_callback=None, cancel_token=None):
         if self.graph is None:
             self.setStatusMessage('Building graph...')
+            if progress_callback is None:
+                progress_callback = lambda _: None
 
             data = self.pca_projection if self.apply_pca else self.data
-
-            self.graph = table_to_graph(
-                data, k_neighbours=self.k_neighbours,
-                metric=METRICS[self.metric_idx][1],
-                progress_callback=progress_callback,
+            k_neighbours = self.k_neighbours
+            metric = METRICS[self.metric_idx][1]
+            backend = ANN_BACKENDS[self.ann_backend_idx][1]
+            n_trees = self.ann_trees if backend != 'exact' else None
+            params = (metric, backend, n_trees, self.apply_pca,
+                      self.pca_components if self.apply_pca else None)
+
+            # Graphs of the same data and parameters are reused from disk;
+            # they are stored before pruning. The neighbours they were built
+            # from are stored too, so that smaller k reuse them after a hit
+            key = cache_key('knn_graph', data, k_neighbours, *params)
+            graph = graph_cache.load_sparse(key)
+            neighbours, recall = self.neighbours, self.recall
+            if neighbours is None:
+                neighbours = self._load_neighbours(data, k_neighbours, params)
+            if graph is None:
+                if neighbours is None:
+                    neighbours, recall = self._find_neighbours(
+                        data, k_neighbours, metric, backend, n_trees,
+                        lambda p: progress_callback(p / 2))
+                    self._check_cancelled(cancel_token)
+                    self._save_neighbours(data, neighbours, params)
+                graph = knn_to_graph(
+                    neighbours[1][:, :k_neighbours],
+                    progress_callback=lambda p: progress_callback(0.5 + p / 2),
+                )
+                self._check_cancelled(cancel_token)
+                graph_cache.save_sparse(key, graph)
+            self._check_cancelled(cancel_token)
+
+            self.neighbours, self.recall = neighbours, recall
+            self.graph = graph
+            if self.use_pruning:
+                self.graph = prune_links(graph, self.prune_threshold)
+                # Links are stored in both directions and self-loops once
+                n_links = (graph.nnz + graph.diagonal().astype(bool).sum()) // 2
+                n_pruned = (graph.nnz - self.graph.nnz) // 2
+                self.pruned_links = n_pruned, n_links
+            self.link_distances = self._link_distances(data, metric)
+
+    def _find_neighbours(self, data, k_neighbours, metric, backend, n_trees,
+                         progress_callback):
+        """Return the nearest neighbours, searched up to `max_k_neighbours`,
+        and the recall of approximate search."""
+        n_neighbours = min(max(k_neighbours, self.max_k_neighbours), len(data))
+        neighbours = nearest_neighbors(
+            data.X, n_neighbours, metric=metric, backend=backend,
+            n_trees=n_trees, random_state=0,
+            progress_callback=progress_callback,
+        )
+        recall = None
+        if backend != 'exact':
+            recall = estimate_recall(
+                data.X, neighbours[1], metric=metric,
+                sample_size=_RECALL_SAMPLE_SIZE, random_state=0,
             )
-
-    def _compute_partition(self):
+        return neighbours, recall
+
+    @staticmethod
+    def _load_neighbours(data, k_neighbours, params):
+        """Return the stored neighbours of the data, or None if they are not
+        stored or there are fewer than `k_neighbours` of them"""
+        distances = graph_cache.load_array(
+            cache_key('knn_distances', data, *params))
+        indices = graph_cache.load_array(
+            cache_key('knn_indices', data, *params))
+        if distances is None or indices is None \
+                or indices.shape[1] < k_neighbours:
+            return None
+        return distances, indices
+
+    @staticmethod
+    def _save_neighbours(data, neighbours, params):
+        distances, indices = neighbours
+        graph_cache.save_array(
+            cache_key('knn_distances', data, *params), distances)
+        graph_cache.save_array(
+            cache_key('knn_indices', data, *params), indices)
+
+    def _partition_key(self):
+        n_runs = self.ensemble_runs if self.use_ensemble else 0
+        return METHODS[self.method_idx][1], self.resolution, n_runs
+
+    def _initial_partition(self):
+        """Seed the Leiden optimisation with the labels of the previous
+        partition, matched by row ids. Rows that were not clustered before
+        start in their own communities. The Louvain dendrogram is always
+        built from singletons, so that it keeps its fine levels."""
+        if not self.warm_start or self.previous_partition is None:
+            return None
+
+        prev_ids, prev_partition = self.previous_partition
+        ids = self.data.ids
+        sorter = np.argsort(prev_ids)
+        positions = np.searchsorted(prev_ids, ids, sorter=sorter)
+        positions = sorter[np.minimum(positions, len(prev_ids) - 1)]
+        found = prev_ids[positions] == ids
+        if not found.any():
+            return None
+
+        partition = np.empty(len(ids), dtype=int)
+        partition[found] = prev_partition[positions[found]]
+        partition[~found] = prev_partition.max() + 1 + np.arange(np.sum(~found))
+        return partition
+
+    def _compute_partition(self, progress_callback=None, cancel_token=None):
         if self.partition is None:
             self.setStatusMessage('Detecting communities...')
             self.setBlocking(True)
 
-            partition = best_partition(self.graph, resolution=self.resolution)
-            self.partition = np.fromiter(list(zip(*sorted(partition.items())))[1], dtype=int)
+            method, resolution, n_runs = key = self._partition_key()
+            # The optimisation holds the GIL, so it runs in a worker process,
+            # which is terminated on cancellation
+            adjacency = self.graph
+            stability = None
+            if n_runs:
+                partition, stability = run_in_process(
+                    ensemble_partition, adjacency, cancel_token=cancel_token,
+                    n_runs=n_runs, resolution=resolution, method=method,
+                    random_state=0,
+                )
+                dendrogram = [partition]
+            elif method == 'louvain':
+                dendrogram = run_in_process(
+                    generate_dendrogram, adjacency,
+                    progress_callback=progress_callback,
+                    cancel_token=cancel_token, resolution=resolution,
+                )
+            else:
+                dendrogram = [run_in_process(
+                    best_partition, adjacency,
+                    progress_callback=progress_callback,
+                    cancel_token=cancel_token,
+                    partition=self._initial_partition(),
+                    resolution=resolution, method=method, random_state=0,
+                )]
+            self._check_cancelled(cancel_token)
+            self._set_dendrogram(dendrogram, stability)
+            self.partition_cache[key] = dendrogram, stability
+            self.previous_partition = self.data.ids, self.partition
 
     def _processing_complete(self):
         self.setStatusMessage('')
@@ -278,84 +687,190 @@ class OWLouvainClustering(widget.OWWidget):
             assert self.__future is not None
             self.__future.cancel()
             self.__future = None
+            # A running task can only be stopped by the queue, which does
+            # not complete when cancelled
+            self.__queue.cancel()
+            self.__queue = None
+            self._processing_complete()
 
         self.__state = self.State.Pending
 
+    def __on_progress(self, queue, progress):
+        # Signals of cancelled queues may still be delivered
+        if queue is self.__queue:
+            self.progressBarSet(100 * progress)
+
+    def __on_complete(self, queue):
+        if queue is self.__queue:
+            self.__future = self.__queue = None
+            self.__state = self.State.Pending
+            self._processing_complete()
+            self._send_data()
+
+    def __on_exception(self, queue, ex):
+        if queue is self.__queue:
+            self._handle_exceptions(ex)
+
+    def _check_data(self):
+        """Show an error and return False if the data cannot be clustered"""
+        if ut.countnans(self.data.X) > 0:
+            self.Error.data_has_nans()
+            return False
+        if len(self.data.domain.attributes) < 1:
+            self.Error.empty_dataset()
+            return False
+        return True
+
     def commit(self):
         self.Error.clear()
         # Kill any running jobs
         self.cancel()
         assert self.__state == self.State.Pending
 
-        if self.data is None:
+        if self.data is None or not self._check_data():
             return
 
-        # Make sure the dataset is ok
-        if ut.countnans(self.data.X) > 0:
-            self.Error.data_has_nans()
-            return
-
-        if len(self.data.domain.attributes) < 1:
-            self.Error.empty_dataset()
-            return
+        # Reuse the partition if it was already computed on this graph
+        key = self._partition_key()
+        if self.partition is None and key in self.partition_cache:
+            self._set_dendrogram(*self.partition_cache[key])
 
         # Prepare the tasks to run
         queue = TaskQueue(parent=self)
 
         if self.pca_projection is None and self.apply_pca:
-            queue.push(namespace(task=self._compute_pca_projection))
+            queue.push(namespace(task=self._compute_pca_projection,
+                                 cancel_token=True))
 
         if self.graph is None:
-            queue.push(namespace(task=self._compute_graph, progress_callback=True))
+            queue.push(namespace(task=self._compute_graph,
+                                 progress_callback=True, cancel_token=True))
 
         if self.partition is None:
-            queue.push(namespace(task=self._compute_partition))
+            queue.push(namespace(task=self._compute_partition,
+                                 progress_callback=True, cancel_token=True))
 
         # Prepare callbacks
-        queue.on_progress.connect(lambda val: self.progressBarSet(100 * val))
-        queue.on_complete.connect(self._processing_complete)
-        queue.on_complete.connect(self._send_data)
-        queue.on_exception.connect(self._handle_exceptions)
+        queue.on_progress.connect(partial(self.__on_progress, queue))
+        queue.on_complete.connect(partial(self.__on_complete, queue))
+        queue.on_exception.connect(partial(self.__on_exception, queue))
 
         # Run the task queue
         self.progressBarInit()
         self.setBlocking(True)
+        self.__queue = queue
         self.__future = self.__executor.submit(queue.start)
         self.__state = self.State.Running
 
-    def _send_data(self):
-        domain = self.data.domain
+    @staticmethod
+    def _cluster_column(name, partition):
+        """Return a variable and values with clusters named by size."""
         # Compute the frequency of each cluster index
-        counts = np.bincount(self.partition)
+        counts = np.bincount(partition)
         indices = np.argsort(counts)[::-1]
         index_map = {n: o for n, o in zip(indices, range(len(indices)))}
-        new_partition = list(map(index_map.get, self.partition))
+        new_partition = list(map(index_map.get, partition))
 
         cluster_var = DiscreteVariable(
-            get_next_name(domain, 'Cluster'),
+            name,
             values=['C%d' % (i + 1) for i, _ in enumerate(np.unique(new_partition))]
         )
+        return cluster_var, new_partition
 
-        new_domain = add_columns(domain, metas=[cluster_var])
+    def _send_data(self):
+        domain = self.data.domain
+        self.Information.approximate_recall.clear()
+        if self.recall is not None:
+            self.Information.approximate_recall(
+                self.recall, min(_RECALL_SAMPLE_SIZE, len(self.data)))
+        self.Information.pruned_links.clear()
+        if self.pruned_links is not None:
+            self.Information.pruned_links(*self.pruned_links)
+        self._update_level_combo()
+
+        cluster_var, new_partition = self._cluster_column(
+            get_next_name(domain, 'Cluster'), self.partition)
+        level_columns = []
+        if self.output_levels and len(self.dendrogram) > 1:
+            level_columns = [
+                self._cluster_column(
+                    get_next_name(domain, 'Cluster (level {})'.format(level + 1)),
+                    partition_at_level(self.dendrogram, level))
+                for level in range(len(self.dendrogram))
+            ]
+
+        new_metas = [cluster_var] + [var for var, _ in level_columns]
+        if self.stability is not None:
+            stability_var = ContinuousVariable(
+                get_next_name(domain, 'Stability'))
+            new_metas.append(stability_var)
+
+        new_domain = add_columns(domain, metas=new_metas)
         new_table = self.data.transform(new_domain)
         new_table.get_column_view(cluster_var)[0][:] = new_partition
+        for var, values in level_columns:
+            new_table.get_column_view(var)[0][:] = values
+        if self.stability is not None:
+            new_table.get_column_view(stability_var)[0][:] = self.stability
         self.Outputs.annotated_data.send(new_table)
 
-        if Graph is not None:
-            graph = Graph(self.graph)
+        if Network is not None:
+            self.Outputs.graph.send(self._network(new_table))
+        elif Graph is not None:
+            graph = Graph(self._networkx_graph())
             graph.set_items(new_table)
             self.Outputs.graph.send(graph)
 
+    def _link_distances(self, data, metric):
+        """Return the links of the graph, each once, and the distances
+        between the linked cells."""
+        links = sp.triu(self.graph).tocoo()
+        distances = pair_distances(data.X, links.row, links.col, metric)
+        return links, distances
+
+    def _network(self, items):
+        """Build the network from the sparse adjacency matrix, with Jaccard
+        weighted links and, as the second set of links, the distances."""
+        links, distances = self.link_distances
+        distances = sp.csr_matrix(
+            (distances, (links.row, links.col)), shape=links.shape)
+        return Network(items, [
+            UndirectedEdges(links.tocsr(), name='Jaccard similarity'),
+            UndirectedEdges(distances, name='Distance'),
+        ])
+
+    def _networkx_graph(self):
+        """Convert the graph to networkx for older versions of the network
+        add-on, with the distances between the linked cells as the
+        `distance` of links."""
+        network = adjacency_to_graph(self.graph)
+        links, distances = self.link_distances
+        nx.set_edge_attributes(
+            network, dict(zip(zip(links.row.tolist(), links.col.tolist()),
+                              distances.tolist())), 'distance')
+        return network
+
     def _invalidate_pca_projection(self):
         self.pca_projection = None
+        self._invalidate_neighbours()
+
+    def _invalidate_neighbours(self):
+        self.neighbours = None
+        self.recall = None
         self._invalidate_graph()
 
     def _invalidate_graph(self):
         self.graph = None
+        self.pruned_links = None
+        self.link_distances = None
+        self.partition_cache = {}
         self._invalidate_partition()
 
     def _invalidate_partition(self):
         self.partition = None
+        self.dendrogram = None
+        self.level = None
+        self.stability = None
 
     @Inputs.data
     def set_data(self, data):
@@ -364,10 +879,13 @@ class OWLouvainClustering(widget.OWWidget):
 
         prev_data, self.data = self.data, data
         self.openContext(self.data)
+        self._enable_warm_start()
 
         # If X hasn't changed, there's no reason to recompute clusters
-        if prev_data and self.data and np.array_equal(self.data.X, prev_data.X):
-            if self.auto_commit:
+        if prev_data and self.data and same_content(self.data, prev_data):
+            # Data that cannot be clustered was never partitioned
+            if self._check_data() and self.auto_commit \
+                    and self.partition is not None:
                 self._send_data()
             return
 
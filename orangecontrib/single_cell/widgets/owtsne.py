@@ -3,20 +3,13 @@ import re
 import sys
 
 import numpy as np
-from joblib.memory import Memory
 
 from AnyQt.QtWidgets import QFormLayout, QApplication
 from AnyQt.QtGui import QPainter
 from AnyQt.QtCore import Qt, QTimer
 
-try:
-    from MulticoreTSNE import MulticoreTSNE
-except ImportError:
-    MulticoreTSNE = None
-
 import Orange.data
 from Orange.data import Domain, Table, ContinuousVariable
-import Orange.projection
 import Orange.distance
 import Orange.misc
 from Orange.misc.environ import cache_dir
@@ -28,13 +21,24 @@ from Orange.widgets.visualize.owscatterplotgraph import OWScatterPlotGraph, Inte
 from Orange.widgets.widget import Msg, OWWidget, Input, Output
 from Orange.widgets.utils.annotated_data import (
     create_annotated_table, create_groups_table, ANNOTATED_DATA_SIGNAL_NAME)
+from orangecontrib.single_cell.widgets.cache import DiskCache, cache_key, \
+    same_content
+from orangecontrib.single_cell.widgets.pca import pca
+from orangecontrib.single_cell.widgets.tsne import TSNEOptimizer, \
+    joint_probabilities, iter_transform
 
 
 RE_FIND_INDEX = r"(^{} \()(\d{{1,}})(\)$)"
 
-tsne_cache = os.path.join(cache_dir(), "tsne")
-memory = Memory(tsne_cache, verbose=0, bytes_limit=1e8)
-memory.reduce_size()
+# Embeddings are small, so the default budget keeps those of many data sets;
+# the widget sets the budget from its settings
+embedding_cache = DiskCache(os.path.join(cache_dir(), "tsne_embeddings"),
+                            size_limit=5e8)
+affinity_cache = DiskCache(os.path.join(cache_dir(), "tsne_affinities"),
+                           size_limit=5e8)
+
+# The number of iterations between updates of the plot
+STEP_ITER = 25
 
 
 ###
@@ -70,24 +74,33 @@ def get_unique_names(names, proposed):
 ###
 
 
-@memory.cache
-def cached_sklearn_tsne(X, perplexity, iter, init):
-    tsne = Orange.projection.TSNE(perplexity=perplexity, n_iter=iter,
-                                  early_exaggeration=1, n_iter_without_progress=50,
-                                  init=init, angle=.8, random_state=0)
-    tsnefit = tsne.fit(X)
-    return tsnefit.embedding_.astype(np.float32)  # Takes half the cache space
+def cached_joint_probabilities(data, perplexity, method='exact'):
+    """Return the affinities of t-SNE between the rows of `data`
 
+    The affinities are stored on disk by the fingerprint of the data, the
+    perplexity and the nearest neighbour method, so runs that differ only in
+    the parameters of the optimization do not compute them again.
 
-@memory.cache
-def multicore_tsne(X, perplexity, iter, init):
-    tsne = MulticoreTSNE(n_iter=iter, perplexity=perplexity,
-                         angle=.8, n_jobs=-1, early_exaggeration=1,
-                         init=init, random_state=0)
-    return tsne.fit_transform(X).astype(np.float32)
+    Parameters
+    ----------
+    data : Orange.data.Table
+        The PCA projection of the input data
+    perplexity : float
+    method : str
+        The nearest neighbour search, see `joint_probabilities`
 
+    Returns
+    -------
+    sp.csr_matrix
 
-compute_tsne_embedding = multicore_tsne if MulticoreTSNE else cached_sklearn_tsne
+    """
+    key = cache_key('tsne_affinities', data, perplexity, method)
+    affinities = affinity_cache.load_sparse(key)
+    if affinities is None:
+        affinities = joint_probabilities(
+            data.X, perplexity, method=method, random_state=0)
+        affinity_cache.save_sparse(key, affinities)
+    return affinities
 
 
 class MDSInteractiveViewBox(InteractiveViewBox):
@@ -143,10 +156,12 @@ class OWtSNE(OWWidget):
     class Inputs:
         data = Input("Data", Orange.data.Table, default=True)
         data_subset = Input("Data Subset", Orange.data.Table)
+        new_data = Input("New Data", Orange.data.Table)
 
     class Outputs:
         selected_data = Output("Selected Data", Orange.data.Table, default=True)
         annotated_data = Output(ANNOTATED_DATA_SIGNAL_NAME, Orange.data.Table)
+        embedded_data = Output("Embedded Data", Orange.data.Table)
 
     settings_version = 2
 
@@ -158,6 +173,8 @@ class OWtSNE(OWWidget):
     max_iter = settings.Setting(300)
     perplexity = settings.Setting(30)
     pca_components = settings.Setting(20)
+    #: The size of the embedding cache on disk in megabytes
+    cache_size = settings.Setting(500)
 
     # output embedding role.
     NoRole, AttrRole, AddAttrRole, MetaRole = 0, 1, 2, 3
@@ -180,6 +197,8 @@ class OWtSNE(OWWidget):
         no_attributes = Msg("Data has no attributes")
         out_of_memory = Msg("Out of memory")
         optimization_error = Msg("Error during optimization\n{}")
+        incompatible_new_data = Msg(
+            "New data does not contain all the genes of the input data")
 
     def __init__(self):
         super().__init__()
@@ -189,10 +208,15 @@ class OWtSNE(OWWidget):
         self.subset_data = None  # type: Optional[Orange.data.Table]
         #: Input data table
         self.signal_data = None
+        #: Input data that is embedded into the existing embedding
+        self.new_data = None  # type: Optional[Orange.data.Table]
+        #: The positions of the new data in the embedding
+        self.new_embedding = None  # type: Optional[np.ndarray]
 
         self._subset_mask = None  # type: Optional[np.ndarray]
         self._invalidated = False
         self.pca_data = None
+        self.pca_model = None
         self._curve = None
         self._data_metas = None
 
@@ -200,6 +224,18 @@ class OWtSNE(OWWidget):
         self.variable_y = ContinuousVariable("tsne-y")
 
         self.__update_loop = None
+        #: Whether the update loop embeds the new data instead of the data
+        self.__embedding_new_data = False
+        #: The positions of the new data in the last step of the loop
+        self.__placed_new_data = None
+        #: The state of the optimization, kept between runs
+        self.__optimizer = None  # type: Optional[TSNEOptimizer]
+        #: The perplexity and PCA components of the optimizer's affinities
+        self.__optimizer_params = None
+        #: The number of iterations at which the current run ends
+        self.__max_iter = 0
+        #: The key of the initial embedding of the optimizer in the cache
+        self.__init_key = None
         # timer for scheduling updates
         self.__timer = QTimer(self, singleShot=True, interval=1,
                               timeout=self.__next_step)
@@ -232,6 +268,12 @@ class OWtSNE(OWWidget):
         gui.hSlider(box, self, 'pca_components', label="Components: ",
                     minValue=2, maxValue=50, step=1) #, callback=self._initialize)
 
+        box = gui.vBox(self.controlArea, "Cache")
+        gui.spin(box, self, "cache_size", 10, 100000, step=10,
+                 label="Size limit (MB): ", callback=self._update_cache_size)
+        self.cache_label = gui.widgetLabel(box, "")
+        self._update_cache_size()
+
         box = gui.vBox(self.mainArea, True, margin=0)
         self.graph = OWMDSGraph(self, box, "MDSGraph", view_box=MDSInteractiveViewBox)
         box.layout().addWidget(self.graph.plot_widget)
@@ -319,7 +361,7 @@ class OWtSNE(OWWidget):
         data : Optional[Orange.data.Table]
         """
         self.signal_data = data
-        if self.data and data and np.array_equal(self.data.X, data.X):
+        if self.data and data and same_content(self.data, data):
             self.closeContext()
             self.data = data
             self.init_attr_values()
@@ -340,6 +382,20 @@ class OWtSNE(OWWidget):
         self._subset_mask = None  # type: Optional[np.ndarray]
         self.controls.graph.alpha_value.setEnabled(subset_data is None)
 
+    @Inputs.new_data
+    @check_sql_input
+    def set_new_data(self, data):
+        """Set the data to place into the embedding of `data`.
+
+        Parameters
+        ----------
+        data: Optional[Orange.data.Table]
+        """
+        if self.__embedding_new_data:
+            self.__set_update_loop(None)
+        self.new_data = data
+        self.new_embedding = None
+
     def _clear(self):
         self.__set_update_loop(None)
         self.__state = OWtSNE.Waiting
@@ -354,7 +410,10 @@ class OWtSNE(OWWidget):
         self.Error.clear()
         self.data = None
         self.pca_data = None
+        self.pca_model = None
         self.embedding = None
+        self.new_embedding = None
+        self.__optimizer = None
         self.init_attr_values()
 
         # if no data, reset plot
@@ -380,6 +439,21 @@ class OWtSNE(OWWidget):
         else:
             self.start()
 
+    def _update_cache_size(self):
+        embedding_cache.size_limit = self.cache_size * 1e6
+        self._update_cache_label()
+
+    def _update_cache_label(self):
+        self.cache_label.setText(
+            "Embeddings: {} hits, {} misses\n"
+            "Affinities: {} hits, {} misses".format(
+                embedding_cache.hits, embedding_cache.misses,
+                affinity_cache.hits, affinity_cache.misses))
+
+    def __embedding_key(self, n_iter):
+        return cache_key('tsne_embedding', self.pca_data, self.perplexity,
+                         self.__init_key, n_iter)
+
     def start(self):
         if not self.data or self.__state == OWtSNE.Running:
             self._update_plot()
@@ -392,48 +466,101 @@ class OWtSNE(OWWidget):
             self.__set_update_loop(None)
 
     def pca_preprocessing(self):
+        # There are at most as many components as rows or attributes
+        n_components = min(self.pca_components, *self.data.X.shape)
         if self.pca_data is not None and \
-                self.pca_data.X.shape[1] == self.pca_components:
+                self.pca_data.X.shape[1] == n_components:
+            return
+        self.pca_model = pca(self.data, self.pca_components,
+                             dtype=np.float32, random_state=0)
+        self.pca_data = self.pca_model(self.data)
+
+    def _embed_new_data(self):
+        """Place the new data into the finished embedding, without changing
+        the positions of the input data."""
+        self.Error.incompatible_new_data.clear()
+        if self.new_data is None or self.new_embedding is not None or \
+                self.embedding is None or self.__state == OWtSNE.Running:
+            return
+        try:
+            new_pca_data = self.pca_model(self.new_data)
+        except ValueError:
+            self.Error.incompatible_new_data()
+            return
+        if np.isnan(new_pca_data.X).any():
+            self.Error.incompatible_new_data()
             return
-        pca = Orange.projection.PCA(
-            n_components=self.pca_components, random_state=0)
-        model = pca(self.data)
-        self.pca_data = model(self.data)
+        # The new points are placed in the update loop, like the optimization
+        # of the embedding, with progress reports and the option to stop
+        self.__set_update_loop(iter_transform(
+            new_pca_data.X, self.pca_data.X, self.embedding,
+            perplexity=self.perplexity, step=STEP_ITER),
+            embedding_new_data=True)
 
     def __start(self):
         self.pca_preprocessing()
+        self.new_embedding = None
         embedding = 'random' if self.embedding is None else self.embedding
-        step_size = self.max_iter
+
+        # A stopped run is resumed and a finished one continues with more
+        # iterations, unless the affinities have changed
+        params = self.perplexity, self.pca_components
+        if self.__optimizer is None or self.__optimizer_params != params:
+            self.__optimizer = None
+            self.__optimizer_params = params
+            self.__max_iter = self.max_iter
+            self.__init_key = cache_key(embedding)
+        elif self.__optimizer.n_iter >= self.__max_iter:
+            self.__max_iter = self.__optimizer.n_iter + self.max_iter
+
+        # The optimization is deterministic, so an embedding from the same
+        # start after the same number of iterations can be reused
+        cached = embedding_cache.load_array(
+            self.__embedding_key(self.__max_iter))
+        self._update_cache_label()
+        if cached is not None:
+            self.__optimizer = None
+            self.__set_update_loop(None)
+            self.embedding = cached
+            self._update_plot()
+            self._embed_new_data()
+            self.unconditional_commit()
+            return
 
         def update_loop(data, max_iter, step, embedding):
             """
             return an iterator over successive improved MDS point embeddings.
             """
             # NOTE: this code MUST NOT call into QApplication.processEvents
-            done = False
-            iterations_done = 0
-
-            while not done:
-                step_iter = min(max_iter - iterations_done, step)
-                embedding = compute_tsne_embedding(
-                    data.X, self.perplexity, step_iter, embedding)
-                iterations_done += step_iter
-                if iterations_done >= max_iter:
-                    done = True
-
-                yield embedding, iterations_done / max_iter
+            if self.__optimizer is None:
+                affinities = cached_joint_probabilities(
+                    data, self.perplexity)
+                self._update_cache_label()
+                self.__optimizer = TSNEOptimizer(
+                    affinities, init=embedding, early_exaggeration=1,
+                    angle=.8, random_state=0)
+            optimizer = self.__optimizer
+            start_iter = optimizer.n_iter
+
+            while optimizer.n_iter < max_iter:
+                embedding = optimizer.optimize(
+                    min(max_iter - optimizer.n_iter, step))
+                yield embedding, \
+                    (optimizer.n_iter - start_iter) / (max_iter - start_iter)
 
         self.__set_update_loop(update_loop(
-            self.pca_data, self.max_iter, step_size, embedding))
+            self.pca_data, self.__max_iter, STEP_ITER, embedding))
         self.progressBarInit(processEvents=None)
 
-    def __set_update_loop(self, loop):
+    def __set_update_loop(self, loop, embedding_new_data=False):
         """
         Set the update `loop` coroutine.
 
         The `loop` is a generator yielding `(embedding, progress)`
         tuples where `embedding` is a `(N, 2) ndarray` of current updated
-        MDS points, and `progress` a float ratio (0 <= progress <= 1)
+        MDS points, and `progress` a float ratio (0 <= progress <= 1).
+        If `embedding_new_data` is set, the points are those of the new
+        data, which are output when the loop finishes.
 
         If an existing update coroutine loop is already in place it is
         interrupted (i.e. closed).
@@ -449,6 +576,8 @@ class OWtSNE(OWWidget):
             self.progressBarFinished(processEvents=None)
 
         self.__update_loop = loop
+        self.__embedding_new_data = loop is not None and embedding_new_data
+        self.__placed_new_data = None
 
         if loop is not None:
             self.setBlocking(True)
@@ -460,7 +589,9 @@ class OWtSNE(OWWidget):
         else:
             self.setBlocking(False)
             self.setStatusMessage("")
-            self.runbutton.setText("Start")
+            paused = self.__optimizer is not None \
+                and self.__optimizer.n_iter < self.__max_iter
+            self.runbutton.setText("Resume" if paused else "Start")
             self.__state = OWtSNE.Finished
             self.__timer.stop()
 
@@ -478,7 +609,15 @@ class OWtSNE(OWWidget):
             embedding, progress = next(self.__update_loop)
             assert self.__update_loop is loop
         except StopIteration:
-            self.__set_update_loop(None)
+            if self.__embedding_new_data:
+                self.new_embedding = self.__placed_new_data
+                self.__set_update_loop(None)
+            else:
+                self.__set_update_loop(None)
+                embedding_cache.save_array(
+                    self.__embedding_key(self.__optimizer.n_iter),
+                    self.embedding)
+                self._embed_new_data()
             self.unconditional_commit()
         except MemoryError:
             self.Error.out_of_memory()
@@ -488,8 +627,11 @@ class OWtSNE(OWWidget):
             self.__set_update_loop(None)
         else:
             self.progressBarSet(100.0 * progress, processEvents=None)
-            self.embedding = embedding
-            self._update_plot()
+            if self.__embedding_new_data:
+                self.__placed_new_data = embedding
+            else:
+                self.embedding = embedding
+                self._update_plot()
             # schedule next update
             self.__timer.start()
 
@@ -520,6 +662,7 @@ class OWtSNE(OWWidget):
             self._invalidated = False
         else:
             self._update_plot(new=True)
+        self._embed_new_data()
         self.unconditional_commit()
 
     def _invalidate_output(self):
@@ -546,24 +689,28 @@ class OWtSNE(OWWidget):
         self.graph.new_data(data, subset_data=subset_data, new=new)
         self.graph.update_data(self.variable_x, self.variable_y, True)
 
-    def commit(self):
-        if self.embedding is not None:
-            names = get_unique_names(
-                [v.name for v in self.data.domain.variables], ["tsne-x", "tsne-y"])
-            output = embedding = Orange.data.Table.from_numpy(
-                Orange.data.Domain([ContinuousVariable(names[0]), ContinuousVariable(names[1])]),
-                self.embedding
-            )
-        else:
-            output = embedding = None
+    @staticmethod
+    def _add_embedding(data, embedding):
+        names = get_unique_names(
+            [v.name for v in data.domain.variables], ["tsne-x", "tsne-y"])
+        domain = data.domain
+        domain = Orange.data.Domain(
+            domain.attributes, domain.class_vars,
+            domain.metas + (ContinuousVariable(names[0]),
+                            ContinuousVariable(names[1])))
+        output = data.transform(domain)
+        output.metas[:, -2:] = embedding
+        return output
 
+    def commit(self):
         if self.embedding is not None and self.data is not None:
-            domain = self.data.domain
-            domain = Orange.data.Domain(domain.attributes,
-                                        domain.class_vars,
-                                        domain.metas + embedding.domain.attributes)
-            output = self.data.transform(domain)
-            output.metas[:, -2:] = embedding.X
+            output = self._add_embedding(self.data, self.embedding)
+        else:
+            output = None
+        if self.new_embedding is not None:
+            embedded = self._add_embedding(self.new_data, self.new_embedding)
+        else:
+            embedded = None
 
         selection = self.graph.get_selection()
         if output is not None and len(selection) > 0:
@@ -576,6 +723,7 @@ class OWtSNE(OWWidget):
             annotated = create_annotated_table(output, selection)
         self.Outputs.selected_data.send(selected)
         self.Outputs.annotated_data.send(annotated)
+        self.Outputs.embedded_data.send(embedded)
 
     def onDeleteWidget(self):
         super().onDeleteWidget()
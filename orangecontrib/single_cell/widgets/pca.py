@@ -0,0 +1,220 @@
+"""PCA by randomized truncated SVD.
+
+Only the few leading components that are used for clustering and embedding
+are computed, following the randomized range finder of Halko et al. (2011).
+The data is never centred explicitly: the products with the centred matrix
+are computed from the products with the original, possibly sparse, matrix
+and the column means, so sparse counts are never densified. Missing values
+are imputed with the column means and discrete attributes are continuized,
+as in Orange's PCA.
+
+"""
+import numpy as np
+import scipy.sparse as sp
+from sklearn.utils import check_random_state
+
+from Orange.data import ContinuousVariable, Domain, Table
+from Orange.preprocess import Continuize
+
+# The number of additional random directions that improve the precision of
+# the leading components
+_OVERSAMPLES = 10
+# The number of power iterations, which help when the singular values decay
+# slowly, as they do for expression data
+_POWER_ITERATIONS = 4
+
+
+def randomized_pca(x, n_components, dtype=np.float64, random_state=None):
+    """Compute the leading principal components of the rows of `x`
+
+    Parameters
+    ----------
+    x : Union[np.ndarray, sp.spmatrix]
+        The data, one point per row; sparse data is converted to CSR and
+        missing values are replaced by the means of their columns
+    n_components : int
+        The number of components; at most the smaller dimension of `x`
+    dtype : np.dtype
+        The precision of the computation; np.float32 halves the memory
+    random_state : Optional[Union[int, np.random.RandomState]]
+
+    Returns
+    -------
+    mean : np.ndarray
+        The mean of the columns, ignoring missing values
+    components : np.ndarray
+        An array of shape (n_components, n_columns) with the principal axes
+    explained_variance : np.ndarray
+        The variance along each component
+
+    """
+    x = _as_array(x, dtype)
+    n_rows, n_columns = x.shape
+    n_components = min(n_components, n_rows, n_columns)
+    n_random = min(n_components + _OVERSAMPLES, n_rows, n_columns)
+    mean = _column_means(x)
+    x = _impute(x, mean)
+
+    # Products with the centred data x - 1 mean^T
+    def dot(matrix):
+        return x.dot(matrix) - mean.dot(matrix)[None, :]
+
+    def transposed_dot(matrix):
+        return x.T.dot(matrix) - mean[:, None] * matrix.sum(axis=0)
+
+    random_state = check_random_state(random_state)
+    basis = random_state.normal(size=(n_columns, n_random)).astype(dtype)
+    basis, _ = np.linalg.qr(dot(basis))
+    for _ in range(_POWER_ITERATIONS):
+        basis, _ = np.linalg.qr(transposed_dot(basis))
+        basis, _ = np.linalg.qr(dot(basis))
+
+    _, singular_values, components = np.linalg.svd(
+        transposed_dot(basis).T, full_matrices=False)
+    components = components[:n_components]
+    # The largest coordinate of each component is positive, so that the
+    # components do not depend on the random directions
+    largest = np.argmax(np.abs(components), axis=1)
+    signs = np.sign(components[np.arange(n_components), largest])
+    components *= signs[:, None]
+    explained_variance = \
+        singular_values[:n_components] ** 2 / max(n_rows - 1, 1)
+    return mean, components.astype(dtype), explained_variance
+
+
+def _as_array(x, dtype):
+    if sp.issparse(x):
+        return sp.csr_matrix(x, dtype=dtype)
+    return np.asarray(x, dtype=dtype)
+
+
+def _column_means(x):
+    """Return the means of the columns of `x`, ignoring missing values;
+    the mean of a column without any values is 0"""
+    n_rows, n_columns = x.shape
+    if sp.issparse(x):
+        missing = np.isnan(x.data)
+        counts = n_rows - np.bincount(x.indices[missing],
+                                      minlength=n_columns)
+        sums = np.bincount(x.indices[~missing], weights=x.data[~missing],
+                           minlength=n_columns)
+    else:
+        missing = np.isnan(x)
+        counts = n_rows - missing.sum(axis=0)
+        sums = np.where(missing, 0, x).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    means[counts == 0] = 0
+    return means.astype(x.dtype)
+
+
+def _impute(x, mean):
+    """Return `x` with missing values replaced by the column means; `x` is
+    copied only if it contains missing values"""
+    if sp.issparse(x):
+        missing = np.isnan(x.data)
+        if missing.any():
+            x = x.copy()
+            x.data[missing] = mean[x.indices[missing]]
+    else:
+        missing = np.isnan(x)
+        if missing.any():
+            x = np.where(missing, mean[None, :], x)
+    return x
+
+
+def _continuize(data):
+    """Replace discrete attributes with indicator columns, as Orange's PCA
+    does; tables with only continuous attributes are returned as they are,
+    so that sparse data is not converted"""
+    if all(var.is_continuous for var in data.domain.attributes):
+        return data
+    return Continuize()(data)
+
+
+class PCAModel:
+    """Projection of data onto principal components
+
+    Parameters
+    ----------
+    attributes : Tuple[Orange.data.Variable]
+        The continuized attributes of the data the components were computed
+        from
+    mean : np.ndarray
+    components : np.ndarray
+    explained_variance : np.ndarray
+
+    """
+    def __init__(self, attributes, mean, components, explained_variance):
+        self.attributes = attributes
+        self.mean = mean
+        self.components = components
+        self.explained_variance = explained_variance
+        self.variables = tuple(
+            ContinuousVariable('PC{}'.format(i + 1))
+            for i in range(len(components)))
+
+    def __call__(self, data):
+        """Project the data onto the components
+
+        The data is continuized and its attributes are matched with those
+        of the model by name, so the data may contain additional attributes
+        or have them in a different order. Missing values are replaced by
+        the means from the data the model was computed from.
+
+        Parameters
+        ----------
+        data : Table
+
+        Returns
+        -------
+        Table
+            A table with the components as attributes, and the class and
+            meta attributes of the data
+
+        Raises
+        ------
+        ValueError
+            If the data lacks any of the model's attributes
+
+        """
+        continuous = _continuize(data)
+        positions = {var.name: i
+                     for i, var in enumerate(continuous.domain.attributes)}
+        missing = [var.name for var in self.attributes
+                   if var.name not in positions]
+        if missing:
+            raise ValueError("Data does not contain attributes {}".format(
+                ", ".join(missing[:5])))
+        columns = [positions[var.name] for var in self.attributes]
+        x = _as_array(continuous.X[:, columns], self.components.dtype)
+        x = _impute(x, self.mean)
+        projection = np.asarray(x.dot(self.components.T)) \
+            - self.mean.dot(self.components.T)
+        domain = Domain(self.variables, data.domain.class_vars,
+                        data.domain.metas)
+        return Table.from_numpy(domain, projection, data.Y, data.metas,
+                                ids=data.ids)
+
+
+def pca(data, n_components, dtype=np.float64, random_state=None):
+    """Compute the principal components of the attributes of a table
+
+    Discrete attributes are replaced by indicator columns and missing values
+    by the means of their columns.
+
+    Parameters
+    ----------
+    data : Table
+    n_components : int
+    dtype : np.dtype
+    random_state : Optional[Union[int, np.random.RandomState]]
+
+    Returns
+    -------
+    PCAModel
+
+    """
+    data = _continuize(data)
+    return PCAModel(data.domain.attributes, *randomized_pca(
+        data.X, n_components, dtype=dtype, random_state=random_state))
@@ -0,0 +1,355 @@
+"""Resumable t-SNE.
+
+The affinities between the points are computed once from their nearest
+neighbours. :class:`TSNEOptimizer` then keeps the whole state of the
+gradient descent (the embedding, the gains and the last update), so the
+optimisation can be advanced a few iterations at a time, paused, resumed
+and continued after it has finished.
+
+New points can be added to an existing embedding with :func:`transform`,
+which optimizes only their positions, or step by step with
+:func:`iter_transform`.
+
+The gradient of the KL divergence is approximated with the multithreaded
+Barnes-Hut implementation of scikit-learn. It is a private function, so
+the supported versions of scikit-learn are pinned in the requirements.
+
+"""
+import os
+
+import numpy as np
+import scipy.sparse as sp
+import sklearn
+from sklearn.neighbors import NearestNeighbors
+from sklearn.utils import check_random_state
+
+from orangecontrib.single_cell.widgets.nearest_neighbors import \
+    nearest_neighbors
+
+try:
+    from sklearn.manifold._t_sne import _kl_divergence_bh
+except ImportError:
+    raise ImportError(
+        "t-SNE requires scikit-learn>=0.22,<1.10 for its Barnes-Hut "
+        "gradient; scikit-learn {} is installed".format(sklearn.__version__))
+
+_MACHINE_EPSILON = np.finfo(np.double).eps
+# The number of steps of the binary search for the bandwidths
+_PERPLEXITY_STEPS = 100
+_PERPLEXITY_TOLERANCE = 1e-5
+# Momentum is lower while the points are first arranged
+_EXPLORATION_ITER = 250
+_EXPLORATION_MOMENTUM = 0.5
+_MOMENTUM = 0.8
+_MIN_GAIN = 0.01
+# The number of cells of the grid along each axis of the embedding, which
+# summarizes the reference points in transform
+_GRID_SIZE = 32
+_MAX_GRADIENT_NORM = 0.25
+# The number of distances between new points and grid cells computed at once
+_TRANSFORM_BLOCK = 1 << 20
+
+
+def joint_probabilities(x, perplexity=30, metric='l2', method='exact',
+                        random_state=None):
+    """Compute the symmetric affinities of t-SNE between the points
+
+    Only the affinities to the `3 * perplexity` nearest neighbours of each
+    point are computed, the others are zero.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The points, one per row
+    perplexity : float
+    metric : str
+        The distance between points, see `nearest_neighbors`
+    method : str
+        The nearest neighbour search, 'exact' or 'rp_forest'
+    random_state : Optional[Union[int, np.random.RandomState]]
+
+    Returns
+    -------
+    sp.csr_matrix
+        Joint probabilities, which sum to 1
+
+    """
+    n_points = len(x)
+    k = min(n_points - 1, int(3 * perplexity) + 1)
+    distances, indices = nearest_neighbors(
+        x, k + 1, metric=metric, backend=method, random_state=random_state)
+
+    # Drop the points themselves from their neighbours; duplicated points
+    # may come first, in which case the last neighbour is dropped
+    own = indices == np.arange(n_points)[:, None]
+    own[~own.any(axis=1), -1] = True
+    distances = distances[~own].reshape(n_points, k)
+    indices = indices[~own].reshape(n_points, k)
+
+    conditional = _conditional_probabilities(distances ** 2, perplexity)
+    conditional = sp.csr_matrix(
+        (conditional.ravel(), indices.ravel(), np.arange(0, n_points * k + 1, k)),
+        shape=(n_points, n_points))
+    joint = conditional + conditional.T
+    joint /= np.maximum(joint.sum(), _MACHINE_EPSILON)
+    joint.sort_indices()
+    return sp.csr_matrix(joint)
+
+
+def _conditional_probabilities(sq_distances, perplexity):
+    """Find the Gaussian bandwidth of every point that gives the desired
+    perplexity of its neighbours' probabilities, by a binary search run on
+    all points at once."""
+    n_points = len(sq_distances)
+    desired_entropy = np.log(perplexity)
+    beta = np.ones(n_points)
+    beta_min = np.full(n_points, -np.inf)
+    beta_max = np.full(n_points, np.inf)
+
+    for _ in range(_PERPLEXITY_STEPS):
+        probabilities = np.exp(-sq_distances * beta[:, None])
+        sums = np.maximum(probabilities.sum(axis=1), _MACHINE_EPSILON)
+        probabilities /= sums[:, None]
+        entropy = np.log(sums) + beta * np.sum(
+            sq_distances * probabilities, axis=1)
+
+        difference = entropy - desired_entropy
+        if np.all(np.abs(difference) <= _PERPLEXITY_TOLERANCE):
+            break
+        # Too high entropy means too wide kernels
+        wider = difference > 0
+        beta_min[wider] = beta[wider]
+        beta_max[~wider] = beta[~wider]
+        beta = np.where(
+            np.isinf(beta_max), beta * 2,
+            np.where(np.isinf(beta_min), beta / 2, (beta_min + beta_max) / 2))
+    return probabilities
+
+
+class TSNEOptimizer:
+    """Gradient descent of t-SNE that can be run in parts
+
+    Parameters
+    ----------
+    affinities : sp.csr_matrix
+        Joint probabilities, see `joint_probabilities`
+    init : Union[str, np.ndarray]
+        The initial embedding or 'random'
+    n_components : int
+    learning_rate : float
+    early_exaggeration : float
+        The factor of the affinities during the first iterations
+    angle : float
+        The trade-off between the speed and accuracy of Barnes-Hut
+    random_state : Optional[Union[int, np.random.RandomState]]
+    n_jobs : Optional[int]
+        The number of threads that compute the gradient, all processors if
+        None
+
+    Attributes
+    ----------
+    embedding : np.ndarray
+        The current embedding
+    n_iter : int
+        The number of iterations run so far
+    kl_divergence : Optional[float]
+        The KL divergence at the last iteration; it is computed only at the
+        last iteration of each call of `optimize`
+
+    """
+    def __init__(self, affinities, init='random', n_components=2,
+                 learning_rate=200., early_exaggeration=1., angle=0.5,
+                 random_state=None, n_jobs=None):
+        self.affinities = sp.csr_matrix(affinities)
+        n_points = self.affinities.shape[0]
+        if isinstance(init, str):
+            if init != 'random':
+                raise ValueError("Unknown initialization '{}'".format(init))
+            init = 1e-4 * check_random_state(random_state).randn(
+                n_points, n_components)
+        self.embedding = np.array(init, dtype=np.float32)
+        if self.embedding.shape != (n_points, n_components):
+            raise ValueError("The initial embedding has a wrong shape")
+
+        self.learning_rate = learning_rate
+        self.early_exaggeration = early_exaggeration
+        self.angle = angle
+        self.n_jobs = n_jobs
+
+        self.n_iter = 0
+        self.kl_divergence = None
+        self._gains = np.ones_like(self.embedding)
+        self._update = np.zeros_like(self.embedding)
+
+    def optimize(self, n_iter):
+        """Run `n_iter` more iterations and return the embedding
+
+        Parameters
+        ----------
+        n_iter : int
+
+        Returns
+        -------
+        np.ndarray
+
+        """
+        n_points, n_components = self.embedding.shape
+        degrees_of_freedom = max(n_components - 1, 1)
+        n_threads = self.n_jobs or os.cpu_count() or 1
+        for i in range(n_iter):
+            exploring = self.n_iter < _EXPLORATION_ITER
+            affinities = self.affinities
+            if exploring and self.early_exaggeration != 1:
+                affinities = affinities * self.early_exaggeration
+            momentum = _EXPLORATION_MOMENTUM if exploring else _MOMENTUM
+
+            # The error is only reported after the last iteration
+            compute_error = i == n_iter - 1
+            error, gradient = _kl_divergence_bh(
+                params=self.embedding.ravel(), P=affinities,
+                degrees_of_freedom=degrees_of_freedom, n_samples=n_points,
+                n_components=n_components, angle=self.angle,
+                compute_error=compute_error, num_threads=n_threads)
+            self._step(gradient.reshape(self.embedding.shape), momentum)
+            if compute_error:
+                self.kl_divergence = error
+            self.n_iter += 1
+        return self.embedding.copy()
+
+    def _step(self, gradient, momentum):
+        """Update the embedding with gains that grow while the direction of
+        the gradient is stable, as in scikit-learn."""
+        increase = self._update * gradient < 0
+        self._gains[increase] += 0.2
+        self._gains[~increase] *= 0.8
+        np.clip(self._gains, _MIN_GAIN, np.inf, out=self._gains)
+
+        self._update *= momentum
+        self._update -= self.learning_rate * self._gains * gradient
+        self.embedding += self._update
+
+
+def transform(x, reference, embedding, perplexity=30, n_iter=100,
+              learning_rate=0.1, exaggeration=1.5, metric='l2',
+              progress_callback=None):
+    """Embed new points into a fixed t-SNE embedding of reference points
+
+    Only the positions of the new points are optimized; the reference
+    embedding does not change. The new points start at the mean position of
+    their nearest reference points, weighted by the affinities, and are then
+    moved to minimise the KL divergence between their affinities to the
+    reference points and those in the embedding. The points do not
+    interact, and the repulsion of the reference points is approximated by
+    the centres of a grid over the embedding, which is built once, so the
+    cost grows with the number of new points and not with the reference.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The new points, in the same space as the reference points
+    reference : np.ndarray
+        The reference points
+    embedding : np.ndarray
+        The embedding of the reference points
+    perplexity : float
+    n_iter : int
+    learning_rate : float
+    exaggeration : float
+        The factor of the attraction to the reference points
+    metric : str
+    progress_callback : Callable[[float], None]
+
+    Returns
+    -------
+    np.ndarray
+        The embedding of the new points
+
+    """
+    steps = iter_transform(x, reference, embedding, perplexity=perplexity,
+                           n_iter=n_iter, learning_rate=learning_rate,
+                           exaggeration=exaggeration, metric=metric)
+    for new_embedding, progress in steps:
+        if progress_callback:
+            progress_callback(progress)
+    return new_embedding
+
+
+def iter_transform(x, reference, embedding, perplexity=30, n_iter=100,
+                   learning_rate=0.1, exaggeration=1.5, metric='l2', step=1):
+    """Embed new points into a fixed t-SNE embedding like :func:`transform`,
+    yielding after every `step` iterations, so that the caller can report
+    the progress or stop early
+
+    Yields
+    ------
+    new_embedding : np.ndarray
+        The current embedding of the new points
+    progress : float
+        The fraction of the iterations that are done
+
+    """
+    embedding = np.asarray(embedding, dtype=float)
+    k = min(len(reference), int(3 * perplexity) + 1)
+    distances, indices = NearestNeighbors(n_neighbors=k, metric=metric) \
+        .fit(reference).kneighbors(x)
+    affinities = _conditional_probabilities(distances ** 2, perplexity)
+    affinities *= exaggeration
+
+    new_embedding = np.einsum(
+        'ij,ijk->ik', affinities, embedding[indices]) / exaggeration
+    centres, counts = _grid_summary(embedding)
+
+    gains = np.ones_like(new_embedding)
+    update = np.zeros_like(new_embedding)
+    for iteration in range(n_iter):
+        gradient = _transform_gradient(
+            new_embedding, affinities, embedding[indices], centres, counts)
+        # Limit the steps, so that the points do not leave the map while
+        # the gains grow
+        norms = np.linalg.norm(gradient, axis=1, keepdims=True)
+        gradient *= np.minimum(1, _MAX_GRADIENT_NORM / np.maximum(norms, 1e-12))
+
+        increase = update * gradient < 0
+        gains[increase] += 0.2
+        gains[~increase] *= 0.8
+        np.clip(gains, _MIN_GAIN, np.inf, out=gains)
+        momentum = _EXPLORATION_MOMENTUM \
+            if iteration < n_iter // 4 else _MOMENTUM
+        update *= momentum
+        update -= learning_rate * gains * gradient
+        new_embedding += update
+        if (iteration + 1) % step == 0 or iteration == n_iter - 1:
+            yield new_embedding.astype(np.float32), (iteration + 1) / n_iter
+
+
+def _grid_summary(embedding):
+    """Return the centres of mass and the numbers of points in the
+    non-empty cells of a grid over the embedding."""
+    low, high = embedding.min(axis=0), embedding.max(axis=0)
+    cells = np.floor((embedding - low) / np.maximum(high - low, 1e-12)
+                     * _GRID_SIZE).clip(0, _GRID_SIZE - 1).astype(int)
+    cells = np.ravel_multi_index(cells.T, (_GRID_SIZE,) * cells.shape[1])
+    cells, labels, counts = np.unique(
+        cells, return_inverse=True, return_counts=True)
+    centres = np.column_stack([
+        np.bincount(labels, weights=column) for column in embedding.T])
+    return centres / counts[:, None], counts
+
+
+def _transform_gradient(points, affinities, neighbours, centres, counts):
+    """The gradient of the KL divergence of each point, whose attraction is
+    to its neighbours and repulsion from the centres of the grid cells."""
+    differences = points[:, None] - neighbours
+    kernel = 1 / (1 + np.sum(differences ** 2, axis=2))
+    attraction = np.einsum('ij,ijk->ik', affinities * kernel, differences)
+
+    repulsion = np.empty_like(points)
+    block_size = max(1, _TRANSFORM_BLOCK // len(centres))
+    for start in range(0, len(points), block_size):
+        differences = points[start:start + block_size, None] - centres
+        kernel = 1 / (1 + np.sum(differences ** 2, axis=2))
+        normalization = kernel.dot(counts)
+        repulsion[start:start + block_size] = np.einsum(
+            'ij,ijk->ik', counts * kernel ** 2, differences) \
+            / normalization[:, None]
+    return 2 * (attraction - repulsion)